@@ -1,4 +1,26 @@
+from collections import OrderedDict
 from typing import Collection
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+from typing import Set
+from typing import Tuple
+from typing import Union
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Model
+from django.db.models import Prefetch
+from django.db.models import QuerySet
+from rest_framework.fields import Field
+from rest_framework.permissions import SAFE_METHODS
+
+__all__ = [
+    'FieldQuery',
+    'OptInFieldsQuerySetMixin',
+    'SerializerOptInFieldsMixin',
+]
 
 
 class SerializerOptInFieldsMixin:
@@ -39,50 +61,263 @@ class SerializerOptInFieldsMixin:
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+        # fields are only built when first accessed so we can decide which fields to keep before they are constructed
+        self._opt_in_requested_fields = None
+
         if not hasattr(self, "context"):
             # serializer invoked without context - inspection?
             return
 
-        pinned_fields = self.get_pinned_fields()
+        request = self.context.get("request")
+        if request is not None:
+            fields_to_include, opt_in_fields_to_include = _get_requested_fields_from_query_params(request)
+        else:
+            fields_to_include, opt_in_fields_to_include = [], []
+
+        fields_to_include = fields_to_include or _parse_field_names(self.context.get("include_fields"))
+        opt_in_fields_to_include = opt_in_fields_to_include or _parse_field_names(self.context.get("opt_in_fields"))
 
-        fields_to_exclude = getattr(self.Meta, "opt_in_only_fields", [])
+        if not fields_to_include:
+            fields_to_exclude = getattr(self.Meta, "opt_in_only_fields", [])
+            fields_to_include = set(self.Meta.fields).difference(set(fields_to_exclude))
 
-        fields_to_include = (
-            (
-                "request" in self.context
-                and "include_fields" in self.context["request"].query_params
-                and self.context["request"].query_params["include_fields"]
-            )
-            or ("include_fields" in self.context and self.context["include_fields"])
-            or set(self.Meta.fields).difference(set(fields_to_exclude))
+        self._opt_in_requested_fields = (
+            set(self.get_pinned_fields())
+            .union(fields_to_include)
+            .union(opt_in_fields_to_include)
         )
 
-        if isinstance(fields_to_include, str):
-            fields_to_include = [fields_to_include]
-
-        fields_to_include_list = []
-        for f in fields_to_include:
-            if f.find(",") != -1:
-                fields_to_include_list += f.split(",")
-            else:
-                fields_to_include_list.append(f)
-
-        opt_in_fields_to_include = (
-            (
-                "request" in self.context
-                and "opt_in_fields" in self.context["request"].query_params
-                and self.context["request"].query_params["opt_in_fields"]
-            )
-            or ("opt_in_fields" in self.context and self.context["opt_in_fields"])
-            or []
+    def is_field_requested(self, field_name: str) -> bool:
+        """
+        Whether a field will be returned by this serializer
+        """
+        return self._opt_in_requested_fields is None or field_name in self._opt_in_requested_fields
+
+    def get_field_names(self, declared_fields, info):
+        # ModelSerializer: only build the fields that have been requested
+        return [
+            field_name
+            for field_name in super().get_field_names(declared_fields, info)
+            if self.is_field_requested(field_name)
+        ]
+
+    def get_fields(self):
+        if self._opt_in_requested_fields is None:
+            return super().get_fields()
+
+        # Serializer.get_fields() deep copies (ie reconstructs) every declared field, including nested serializers;
+        # hide the unrequested ones so that this is only done for fields that will be returned
+        self._declared_fields = OrderedDict(
+            (field_name, field)
+            for field_name, field in type(self)._declared_fields.items()
+            if self.is_field_requested(field_name)
+        )
+        try:
+            fields = super().get_fields()
+        finally:
+            del self._declared_fields
+
+        return OrderedDict(
+            (field_name, field)
+            for field_name, field in fields.items()
+            if self.is_field_requested(field_name)
         )
 
-        for f in list(self.fields.keys()):
-            if (
-                f not in pinned_fields
-                and f not in fields_to_include_list
-                and f not in opt_in_fields_to_include
-            ):
-                del self.fields[f]
 
-        return
+def _parse_field_names(value: Union[None, str, Sequence[str]]) -> List[str]:
+    """
+    Parse include_fields / opt_in_fields: either a comma separated string or a list of them
+    """
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = [value]
+    return [field_name for item in value for field_name in item.split(",") if field_name]
+
+
+def _get_requested_fields_from_query_params(request) -> Tuple[List[str], List[str]]:
+    """
+    Get the include_fields & opt_in_fields requested in the query params
+
+    Results are stored on the request so that they're only parsed once, no matter how many serializers (eg nested
+    or list serializers) are created during the request
+    """
+    try:
+        return request._opt_in_fields_query_params
+    except AttributeError:
+        pass
+
+    query_params = getattr(request, "query_params", {})
+
+    def get_param(name):
+        if hasattr(query_params, "getlist"):
+            return query_params.getlist(name)
+        return query_params.get(name)
+
+    requested = (
+        _parse_field_names(get_param("include_fields")),
+        _parse_field_names(get_param("opt_in_fields")),
+    )
+    request._opt_in_fields_query_params = requested
+    return requested
+
+
+class FieldQuery(NamedTuple):
+    """
+    The columns & relations that a serializer field needs (see OptInFieldsQuerySetMixin)
+    """
+    # columns to load (as passed to QuerySet.only(); may span relations eg 'region__name')
+    only: Sequence[str] = ()
+    select_related: Sequence[str] = ()
+    prefetch_related: Sequence[Union[str, Prefetch]] = ()
+
+
+def _get_prefetch_to(lookup: Union[str, Prefetch]) -> str:
+    return lookup.prefetch_to if isinstance(lookup, Prefetch) else lookup
+
+
+def _get_select_related_paths(select_related: Dict, prefix: str = '') -> List[str]:
+    """
+    Flatten a Query.select_related tree into lookup paths
+    """
+    paths = []
+    for name, children in select_related.items():
+        path = prefix + name
+        child_paths = _get_select_related_paths(children, path + '__')
+        paths.extend(child_paths or [path])
+    return paths
+
+
+class OptInFieldsQuerySetMixin:
+    """
+    ViewSet mixin that loads only the columns & relations needed by the fields the serializer will actually
+    return (see SerializerOptInFieldsMixin)
+
+    For each returned field the serializer's Meta.field_queries is consulted; this maps field names to FieldQuery
+    objects describing the columns & relations the field needs. Undeclared fields that map directly onto a model
+    field are inferred.
+
+    - Relations declared for returned fields are added to the queryset with select_related() / prefetch_related()
+    - Relations declared for fields that won't be returned are removed from the queryset (so get_queryset() can
+      still load them when they are needed)
+    - If every returned field's columns are known then only() is used to load just those columns; if there is any
+      field whose columns can't be determined (eg a SerializerMethodField without a declaration) then all columns
+      are loaded
+
+    Only applies to safe (read only) requests: updates load the whole record.
+
+    The pruned queryset is built once per request (building it requires creating the serializer) and a fresh copy of
+    it is returned by each get_queryset() call.
+    """
+
+    def get_queryset(self):
+        request = getattr(self, 'request', None)
+        if request is None or request.method not in SAFE_METHODS:
+            return super().get_queryset()
+        cached_request, queryset = getattr(self, '_opt_in_fields_queryset', (None, None))
+        if cached_request is not request:
+            queryset = self.prune_queryset(super().get_queryset(), self.get_serializer())
+            self._opt_in_fields_queryset = (request, queryset)
+        # don't share the result cache between callers
+        return queryset.all()
+
+    def get_field_query(self, model: Model, field_name: str, field: Field, field_queries: Dict[str, FieldQuery]) -> Optional[FieldQuery]:
+        """
+        Get the columns & relations needed by a serializer field
+
+        :return: FieldQuery, or None if they can't be determined
+        """
+        try:
+            return field_queries[field_name]
+        except KeyError:
+            pass
+
+        source_attrs = getattr(field, 'source_attrs', None)
+        if not source_attrs or len(source_attrs) != 1:
+            # '*' or a dotted source
+            return None
+        try:
+            model_field = model._meta.get_field(source_attrs[0])
+        except FieldDoesNotExist:
+            # property or method
+            return None
+
+        if model_field.many_to_many or model_field.one_to_many:
+            # loaded separately; doesn't need any columns
+            return FieldQuery()
+        if model_field.concrete:
+            return FieldQuery(only=[model_field.name])
+        # reverse one to one
+        return None
+
+    def prune_queryset(self, queryset: QuerySet, serializer) -> QuerySet:
+        """
+        Restrict queryset to the columns & relations needed by serializer's fields
+        """
+        meta = getattr(serializer, 'Meta', None)
+        field_queries = getattr(meta, 'field_queries', {})
+        model = queryset.model
+
+        only: Set[str] = {model._meta.pk.name}
+        restrict_columns = True
+        select_related: List[str] = []
+        prefetch_related: List[Union[str, Prefetch]] = []
+        for field_name, field in serializer.fields.items():
+            field_query = self.get_field_query(model, field_name, field, field_queries)
+            if field_query is None:
+                restrict_columns = False
+                continue
+            only.update(field_query.only)
+            select_related.extend(field_query.select_related)
+            prefetch_related.extend(field_query.prefetch_related)
+
+        # relations that were only needed by fields that have been opted out
+        unused_select_related = set()
+        unused_prefetch_related = set()
+        for field_name, field_query in field_queries.items():
+            if field_name not in serializer.fields:
+                unused_select_related.update(field_query.select_related)
+                unused_prefetch_related.update(_get_prefetch_to(lookup) for lookup in field_query.prefetch_related)
+        unused_select_related.difference_update(select_related)
+        unused_prefetch_related.difference_update(_get_prefetch_to(lookup) for lookup in prefetch_related)
+
+        if isinstance(queryset.query.select_related, dict):
+            existing = _get_select_related_paths(queryset.query.select_related)
+            kept = [path for path in existing if path not in unused_select_related]
+            if len(kept) != len(existing):
+                queryset = queryset.select_related(None)
+            select_related = kept + select_related
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+
+        existing = list(queryset._prefetch_related_lookups)
+        kept = [lookup for lookup in existing if _get_prefetch_to(lookup) not in unused_prefetch_related]
+        if len(kept) != len(existing):
+            queryset = queryset.prefetch_related(None).prefetch_related(*kept)
+        if prefetch_related:
+            queryset = queryset.prefetch_related(*prefetch_related)
+
+        if restrict_columns and queryset.query.select_related is not True:
+            declared_only = set(only)
+            for path in _get_select_related_paths(queryset.query.select_related or {}):
+                # django restricts columns per model rather than per relation, so a related record with no declared
+                # columns needs all of its columns listed explicitly in case the same model is restricted elsewhere
+                related_model = model
+                parts = path.split('__')
+                for i, part in enumerate(parts):
+                    related_model = related_model._meta.get_field(part).related_model
+                    prefix = '__'.join(parts[:i + 1])
+                    only.add(prefix)
+                    if not any(column.startswith(prefix + '__') for column in declared_only):
+                        only.update(f'{prefix}__{field.name}' for field in related_model._meta.concrete_fields)
+            # prefetched forward relations need their foreign key columns
+            for lookup in queryset._prefetch_related_lookups:
+                name = _get_prefetch_to(lookup).split('__')[0]
+                try:
+                    if model._meta.get_field(name).concrete:
+                        only.add(name)
+                except FieldDoesNotExist:
+                    pass
+            queryset = queryset.only(*only)
+
+        return queryset
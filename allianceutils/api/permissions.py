@@ -1,6 +1,32 @@
+from itertools import islice
+from typing import Dict
+from typing import FrozenSet
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Type
+
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.db.models import Model
+from django.db.models import Q
+from django.db.models import QuerySet
+from rest_framework.filters import BaseFilterBackend
+from rest_framework.generics import GenericAPIView
 from rest_framework.permissions import BasePermission
+from rest_framework.permissions import SAFE_METHODS
+
+from allianceutils.auth.permission_cache import cached_has_perm
+from allianceutils.auth.permission_cache import cached_has_perms
+
+try:
+    from allianceutils.rules import get_permission_q
+    from allianceutils.rules import has_perms_batch
+except ImportError:
+    # django-rules is not installed; every permission will be checked in python
+    get_permission_q = None
+    has_perms_batch = None
 
 
 class SimpleDjangoObjectPermissions(BasePermission):
@@ -17,13 +43,13 @@ class SimpleDjangoObjectPermissions(BasePermission):
     self.check_object_permissions(self.request, obj)
     """
     def has_permission(self, request, view):
-        return request.user.has_perm(view.permission_required)
+        return cached_has_perm(request.user, view.permission_required)
 
     def has_object_permission(self, request, view, obj):
         # Note: this assertion may fail with django_rules as it will happily try to check the same predicate regardless
         # of whether obj is supplied or not, meaning that both calls below will return True.
-        has_perm_global = request.user.has_perm(view.permission_required)
-        has_perm_obj = request.user.has_perm(view.permission_required, obj)
+        has_perm_global = cached_has_perm(request.user, view.permission_required)
+        has_perm_obj = cached_has_perm(request.user, view.permission_required, obj)
         assert not (has_perm_global and has_perm_obj), (
             "Object level and global permissions shouldn't both return True. "
             "This may indicate a potential security issue with your permissions."
@@ -42,6 +68,12 @@ class GenericDjangoViewsetPermissions(BasePermission):
         }
     then no permissions will be required for the create action, but permissions
     for other actions will remain unchanged.
+
+    If the user has no global permission for a detail action then get_object() is called to check object
+    permissions; the fetched object is then reused when the view itself calls get_object(). Set
+    permission_cache_object = False on the viewset if it needs get_object() to refetch the object.
+
+    Permission checks are memoized within a permission_cache() context (see PermissionCacheMiddleware)
     """
 
     # Maps actions to required permission strings. *All* strings must be present
@@ -80,6 +112,20 @@ class GenericDjangoViewsetPermissions(BasePermission):
             return view.get_permission_model()
         return view.get_queryset().model
 
+    def get_static_model(self, viewset_class) -> Optional[Type[Model]]:
+        """
+        Get the model that get_model() will return for every instance of viewset_class, or None if it can only be
+        determined per request (ie get_model(), get_permission_model() or get_queryset() has been overridden)
+        """
+        if type(self).get_model is not GenericDjangoViewsetPermissions.get_model:
+            return None
+        if hasattr(viewset_class, 'get_permission_model'):
+            return None
+        queryset = getattr(viewset_class, 'queryset', None)
+        if queryset is None or getattr(viewset_class, 'get_queryset', None) is not GenericAPIView.get_queryset:
+            return None
+        return queryset.model
+
     def get_actions_to_perms_map(self):
         """
         Merge the default actions to perms map with the class overrides & return
@@ -91,18 +137,35 @@ class GenericDjangoViewsetPermissions(BasePermission):
 
         return self._saved_actions_to_perms_map
 
+    def get_permission_table(self, viewset_class) -> 'ViewsetPermissionTable':
+        """
+        Get the compiled permission table for a viewset class
+
+        Tables are built on first use (or by the check_viewset_permission_tables system check) and then shared by
+        every request; the permission class's actions to perms map is assumed not to change at runtime.
+        """
+        key = (type(self), viewset_class)
+        try:
+            return _permission_tables[key]
+        except KeyError:
+            pass
+
+        table = ViewsetPermissionTable(
+            permission=self,
+            model=self.get_static_model(viewset_class),
+            list_actions=self._find_list_actions(viewset_class),
+        )
+        _permission_tables[key] = table
+        return table
+
     def get_permissions_for_action(self, action, view):
         """Given a model and an action, return the list of permission
         codes that the user is required to have."""
 
-        model_cls = self.get_model(view)
-        kwargs = {
-            'app_label': model_cls._meta.app_label,
-            'model_name': model_cls._meta.model_name,
-        }
-        perms_map = self.get_actions_to_perms_map()
+        table = self.get_permission_table(type(view))
+        model_cls = table.model or self.get_model(view)
         try:
-            return [perm % kwargs for perm in perms_map[action]]
+            return list(table.get_actions_to_perms(model_cls)[action])
         except KeyError:
             raise ImproperlyConfigured('Missing GenericDjangoViewsetPermissions action permission for %s' % action)
 
@@ -110,30 +173,29 @@ class GenericDjangoViewsetPermissions(BasePermission):
         """
         Get the list actions; these will not have get_object() invoked when checking permissions
         """
-        viewset_class = viewset.__class__
+        return self.get_permission_table(type(viewset)).list_actions
 
-        # Is this really ok to be caching on this another object?
-        if not hasattr(viewset_class, '_saved_permission_list_actions'):
-            viewset_class._saved_permission_list_actions = set(self.default_list_routes)
+    def _find_list_actions(self, viewset_class) -> FrozenSet[str]:
+        list_actions = set(self.default_list_routes)
 
-            # Determine any `@list_route` decorated methods on the viewset
-            for methodname in dir(viewset_class):
-                method = getattr(viewset_class, methodname)
+        # Determine any `@list_route` decorated methods on the viewset
+        for methodname in dir(viewset_class):
+            method = getattr(viewset_class, methodname)
 
-                # pre-3.9 DRF
-                http_methods = getattr(method, 'bind_to_methods', None)
-                # Only certain methods do not require an object
-                if http_methods and all(m.lower() in ('header', 'get', 'post',) for m in http_methods):
-                    if getattr(method, 'detail', None) is False:
-                        viewset_class._saved_permission_list_actions.add(methodname)
+            # pre-3.9 DRF
+            http_methods = getattr(method, 'bind_to_methods', None)
+            # Only certain methods do not require an object
+            if http_methods and all(m.lower() in ('header', 'get', 'post',) for m in http_methods):
+                if getattr(method, 'detail', None) is False:
+                    list_actions.add(methodname)
 
-                # post-3.9 DRF
-                if not http_methods and hasattr(method, 'mapping'):
-                    if all(m.lower() in ('header', 'get', 'post',) for m in getattr(method, 'mapping').keys()):
-                        if getattr(method, 'detail', None) is False: # the detail remains accessible - just bind_to_methods' gone.
-                            viewset_class._saved_permission_list_actions.add(methodname)
+            # post-3.9 DRF
+            if not http_methods and hasattr(method, 'mapping'):
+                if all(m.lower() in ('header', 'get', 'post',) for m in getattr(method, 'mapping').keys()):
+                    if getattr(method, 'detail', None) is False: # the detail remains accessible - just bind_to_methods' gone.
+                        list_actions.add(methodname)
 
-        return viewset_class._saved_permission_list_actions
+        return frozenset(list_actions)
 
     def has_permission(self, request, viewset):
 
@@ -157,14 +219,24 @@ class GenericDjangoViewsetPermissions(BasePermission):
         perms = self.get_permissions_for_action(action, viewset)
 
         # Check permissions for action available irrespective of object
-        if user.has_perms(perms):
+        if cached_has_perms(user, perms):
             return True
 
         # Action relates to object, check object level permission
         if action not in self.get_list_actions(viewset):
             # This should invoke self.check_object_permissions() which
             # will then invoke has_object_permission()
-            viewset.get_object()   # will raise an exception if permission denied
+            obj = viewset.get_object()   # will raise an exception if permission denied
+            if getattr(viewset, 'permission_cache_object', True):
+                # The view will normally call get_object() again; return the object we already fetched (and which
+                # already passed check_object_permissions()) rather than running the same query a second time.
+                # A new viewset instance is created for each request so this only lasts for the current request.
+                viewset.get_object = lambda: obj
+            return True
+
+        # Records the user has no object permission for will be removed from the list; this is only safe for actions
+        # that are known to pass their queryset through the filter backends
+        if request.method in SAFE_METHODS and _uses_object_permission_filter(viewset, action):
             return True
 
         return False
@@ -176,4 +248,141 @@ class GenericDjangoViewsetPermissions(BasePermission):
             return True
         perms = self.get_permissions_for_action(action, viewset)
         user = request.user
-        return user.has_perms(perms, obj)
+        return cached_has_perms(user, perms, obj)
+
+
+class ViewsetPermissionTable:
+    """
+    The permissions GenericDjangoViewsetPermissions requires for each action of a viewset class
+    """
+    # model that permissions are checked against, or None if it has to be determined per request
+    model: Optional[Type[Model]]
+    # actions that don't operate on a single object
+    list_actions: FrozenSet[str]
+
+    def __init__(self, permission: GenericDjangoViewsetPermissions, model: Optional[Type[Model]], list_actions: FrozenSet[str]):
+        self.model = model
+        self.list_actions = list_actions
+        self._actions_to_perms_map = permission.get_actions_to_perms_map()
+        self._actions_to_perms = {}
+
+    def get_actions_to_perms(self, model: Type[Model]) -> Dict[str, List[str]]:
+        """
+        Get the concrete permission names required for each action when checked against model
+        """
+        try:
+            return self._actions_to_perms[model]
+        except KeyError:
+            pass
+
+        kwargs = {
+            'app_label': model._meta.app_label,
+            'model_name': model._meta.model_name,
+        }
+        actions_to_perms = {
+            action: [perm % kwargs for perm in perms]
+            for action, perms in self._actions_to_perms_map.items()
+        }
+        self._actions_to_perms[model] = actions_to_perms
+        return actions_to_perms
+
+
+# (permission class, viewset class) -> permission table
+_permission_tables: Dict[Tuple[type, type], ViewsetPermissionTable] = {}
+
+
+# actions that run ObjectPermissionFilterBackend unless the viewset sets object_permission_filter_actions
+DEFAULT_OBJECT_PERMISSION_FILTER_ACTIONS = ('list',)
+
+
+def _uses_object_permission_filter(view, action: Optional[str]) -> bool:
+    if action not in getattr(view, 'object_permission_filter_actions', DEFAULT_OBJECT_PERMISSION_FILTER_ACTIONS):
+        return False
+    return any(
+        issubclass(backend, ObjectPermissionFilterBackend)
+        for backend in getattr(view, 'filter_backends', ())
+    )
+
+
+class ObjectPermissionFilterBackend(BaseFilterBackend):
+    """
+    Filters the queryset for list actions down to records that the user has object permissions for.
+
+    Use with GenericDjangoViewsetPermissions; list actions are then allowed for users without the global
+    permission, who will only see records that they have object permissions for.
+
+    If a permission's rule declares an equivalent Q expression (see allianceutils.rules.filterable) then the
+    filtering is done in the database, otherwise records are fetched in batches and checked in python.
+
+    Only the actions in the viewset's object_permission_filter_actions (default: just 'list') are allowed without the
+    global permission; add any custom list actions that call filter_queryset() to it.
+    """
+
+    # number of records to fetch & check at a time for permissions that have no Q expression
+    batch_size = 1000
+
+    def get_list_permissions(self, request, view) -> Optional[List[str]]:
+        """
+        Get the permissions required for the current list action, or None if this isn't a list action
+        """
+        action = getattr(view, 'action', None)
+        for permission in view.get_permissions():
+            if isinstance(permission, GenericDjangoViewsetPermissions):
+                if action not in permission.get_list_actions(view):
+                    return None
+                return permission.get_permissions_for_action(action, view)
+        return None
+
+    def filter_queryset(self, request, queryset: QuerySet, view) -> QuerySet:
+        if request.method not in SAFE_METHODS:
+            return queryset
+
+        perms = self.get_list_permissions(request, view)
+        user = request.user
+        if not perms or cached_has_perms(user, perms):
+            return queryset
+
+        python_perms = []
+        for perm in perms:
+            q = get_permission_q(perm, user) if get_permission_q is not None else None
+            if q is None:
+                python_perms.append(perm)
+            else:
+                queryset = queryset.filter(q)
+
+        if python_perms:
+            queryset = self.filter_queryset_in_python(user, python_perms, queryset)
+
+        return queryset
+
+    def filter_queryset_in_python(self, user, perms: List[str], queryset: QuerySet) -> QuerySet:
+        """
+        Filter queryset by checking perms against each record in python
+
+        The matching pks are passed back to the database so this is limited by the database's maximum number of query
+        parameters; declare a Q expression for rules that may match more records than this
+        """
+        allowed_pks = []
+        records = queryset.iterator(chunk_size=self.batch_size)
+        for batch in iter(lambda: list(islice(records, self.batch_size)), []):
+            if has_perms_batch is not None:
+                results = has_perms_batch(user, perms, batch)
+            else:
+                results = [user.has_perms(perms, obj) for obj in batch]
+            allowed_pks.extend(obj.pk for obj, allowed in zip(batch, results) if allowed)
+
+        if not allowed_pks:
+            return queryset.none()
+
+        max_query_params = connections[queryset.db].features.max_query_params
+        if max_query_params is not None and len(allowed_pks) >= max_query_params:
+            raise ImproperlyConfigured(
+                f'{type(self).__name__}: {len(allowed_pks)} records matched {", ".join(perms)} which is too many to '
+                f'filter in python; use allianceutils.rules.filterable to declare a Q expression for these rules'
+            )
+
+        # some databases (eg oracle) also limit the number of items in a single IN list
+        q = Q()
+        for i in range(0, len(allowed_pks), self.batch_size):
+            q |= Q(pk__in=allowed_pks[i:i + self.batch_size])
+        return queryset.filter(q)
@@ -1,8 +1,15 @@
+from typing import FrozenSet
+from typing import Iterable
+from typing import NamedTuple
 from typing import Optional
 
 from authtools.backends import CaseInsensitiveUsernameFieldBackendMixin
+from django.contrib.auth import get_backends
 from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import Permission
+from django.core.cache import caches
+from django.core.exceptions import PermissionDenied
 from django.db.models import Model
 
 
@@ -58,6 +65,180 @@ class MinimalModelBackend:
         return False
 
 
+class PermissionSnapshot(NamedTuple):
+    # global permissions the user has
+    granted: FrozenSet[str]
+    # global permissions the user does not have
+    denied: FrozenSet[str]
+
+
+PERMISSION_SNAPSHOT_VERSION_KEY = 'allianceutils.permission_snapshot_version'
+
+
+def invalidate_permission_snapshots(cache_alias: str = 'default'):
+    """
+    Discard all cross-request permission snapshots (see PermissionSnapshotBackendMixin)
+
+    Call this whenever global permissions change (eg a user's groups are changed or rules are redefined)
+    """
+    cache = caches[cache_alias]
+    try:
+        cache.incr(PERMISSION_SNAPSHOT_VERSION_KEY)
+    except ValueError:
+        # key doesn't exist yet
+        cache.add(PERMISSION_SNAPSHOT_VERSION_KEY, 1, timeout=None)
+
+
+class PermissionSnapshotBackendMixin:
+    """
+    Backend mixin that answers repeated global (non-object) permission checks without consulting the other backends
+    again
+
+    By default each global permission is checked against every other backend the first time it is needed and the
+    result is stored on the user object (ie it lasts for the current request).
+
+    If permission_snapshot_timeout is set then the first global check instead builds a snapshot of all of the user's
+    global permissions by asking every other backend about every permission in get_snapshot_permissions(). The
+    snapshot is stored on the user object and in django's cache so that later requests don't need to check anything.
+
+    This should be the first backend in AUTHENTICATION_BACKENDS: checks for permissions that have already been
+    decided are answered without consulting any other backend.
+    """
+
+    # seconds to cache snapshots across requests; None to only keep decisions for the lifetime of the user object
+    permission_snapshot_timeout: Optional[int] = None
+    permission_snapshot_cache_alias: str = 'default'
+    # other permissions (eg django-rules permissions with global rules) to include in cross-request snapshots
+    permission_snapshot_extra_permissions: Iterable[str] = ()
+
+    def get_snapshot_permissions(self) -> Iterable[str]:
+        """
+        Get the names of the permissions to include in cross-request snapshots
+
+        Defaults to all django permissions plus permission_snapshot_extra_permissions. django-rules permissions
+        are not included unless listed there: many rules are object-only, and every permission in the snapshot is
+        evaluated for every user on every cache miss.
+        """
+        perms = {
+            '%s.%s' % (app_label, codename)
+            for app_label, codename
+            in Permission.objects.values_list('content_type__app_label', 'codename')
+        }
+        perms.update(self.permission_snapshot_extra_permissions)
+        return perms
+
+    def backends_have_perm(self, user: Model, perm: str) -> bool:
+        """
+        Check whether any of the other backends grant user the global permission perm
+        """
+        # mirrors django.contrib.auth.models._user_has_perm()
+        for backend in get_backends():
+            if isinstance(backend, PermissionSnapshotBackendMixin) or not hasattr(backend, 'has_perm'):
+                continue
+            try:
+                if backend.has_perm(user, perm):
+                    return True
+            except PermissionDenied:
+                return False
+        return False
+
+    def build_permission_snapshot(self, user: Model) -> PermissionSnapshot:
+        granted = set()
+        denied = set()
+        for perm in self.get_snapshot_permissions():
+            try:
+                has_perm = self.backends_have_perm(user, perm)
+            except Exception:
+                # eg an object-only rule that can't be checked without an object; leave it out of the snapshot so
+                # that it is checked normally
+                continue
+            if has_perm:
+                granted.add(perm)
+            else:
+                denied.add(perm)
+        return PermissionSnapshot(frozenset(granted), frozenset(denied))
+
+    def get_permission_snapshot(self, user: Model) -> Optional[PermissionSnapshot]:
+        """
+        Get the user's cross-request permission snapshot, or None if it is still being built
+        """
+        try:
+            return user._permission_snapshot
+        except AttributeError:
+            pass
+
+        # other backends may check permissions (eg rules predicates built with allianceutils.rules.has_perm());
+        # these are answered normally while the snapshot is being built
+        user._permission_snapshot = None
+        try:
+            cache = caches[self.permission_snapshot_cache_alias]
+            version = cache.get(PERMISSION_SNAPSHOT_VERSION_KEY, 0)
+            key = 'allianceutils.permission_snapshot:%s:%s' % (user.pk, version)
+            snapshot = cache.get(key)
+            if snapshot is None:
+                snapshot = self.build_permission_snapshot(user)
+                cache.set(key, tuple(snapshot), timeout=self.permission_snapshot_timeout)
+            else:
+                snapshot = PermissionSnapshot(*snapshot)
+        except BaseException:
+            del user._permission_snapshot
+            raise
+
+        user._permission_snapshot = snapshot
+        return snapshot
+
+    def get_permission_decision(self, user: Model, perm: str) -> Optional[bool]:
+        """
+        Get whether the other backends grant user the global permission perm, checking them only the first time
+        each permission is needed for this user object
+
+        :return: the decision, or None if perm is still being checked
+        """
+        try:
+            decisions = user._permission_decisions
+        except AttributeError:
+            decisions = user._permission_decisions = {}
+        try:
+            return decisions[perm]
+        except KeyError:
+            pass
+
+        # as with snapshots, checks for the same permission made while it is being decided are answered normally
+        decisions[perm] = None
+        try:
+            decision = self.backends_have_perm(user, perm)
+        except BaseException:
+            del decisions[perm]
+            raise
+        decisions[perm] = decision
+        return decision
+
+    def has_perm(self, user: Model, perm: str, obj: Optional[Model] = None) -> bool:
+        if super().has_perm(user, perm, obj):
+            return True
+        if obj is not None or user.pk is None:
+            return False
+
+        if self.permission_snapshot_timeout is None:
+            decision = self.get_permission_decision(user, perm)
+            if decision is None:
+                return False
+            if decision:
+                return True
+            # no other backend grants this permission; stop django from asking them again
+            raise PermissionDenied
+
+        snapshot = self.get_permission_snapshot(user)
+        if snapshot is None:
+            return False
+        if perm in snapshot.granted:
+            return True
+        if perm in snapshot.denied:
+            # no other backend grants this permission; stop django from asking them again
+            raise PermissionDenied
+        return False
+
+
 class ProfileModelBackend(
     ProfileModelBackendMixin, CaseInsensitiveUsernameFieldBackendMixin, MinimalModelBackend
 ):
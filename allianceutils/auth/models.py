@@ -1,5 +1,13 @@
+from itertools import islice
+from typing import Any
+from typing import AsyncIterator
+from typing import Dict
 from typing import Iterable
+from typing import List
+from typing import NamedTuple
 from typing import Optional
+from typing import Set
+from typing import Tuple
 from typing import Type
 from typing import Union
 
@@ -7,12 +15,20 @@ from django.contrib.auth.models import BaseUserManager
 from django.contrib.auth.models import UserManager
 from django.core import checks
 from django.core.exceptions import ValidationError
+from django.db import connections
+from django.db import router
+from django.db import transaction
 from django.db.models import Manager
 from django.db.models import Model
+from django.db.models import Prefetch
 from django.db.models import QuerySet
+from django.db.models.fields.reverse_related import ForeignObjectRel
+from django.db.models.functions import Lower
 from django.db.models.query import ModelIterable
 
 from allianceutils.checks import ID_ERROR_PROFILE_RELATED_TABLES
+from allianceutils.util.scoped_context import make_context_var
+from allianceutils.util.scoped_context import ScopedContext
 
 
 class GenericUserProfileIterable(ModelIterable):
@@ -26,6 +42,26 @@ class GenericUserProfileIterable(ModelIterable):
         else:
             yield from super().__iter__()
 
+    def __aiter__(self) -> AsyncIterator[Model]:
+        """
+        Async version of __iter__(): records are fetched (and profiles resolved) in a worker thread one
+        chunk_size batch at a time so that the event loop isn't blocked
+        """
+        # imported here so that asgiref is only required if async iteration is used
+        from asgiref.sync import sync_to_async
+
+        async def generator():
+            sync_iterator = iter(self)
+            next_chunk = sync_to_async(lambda: list(islice(sync_iterator, self.chunk_size)), thread_sensitive=True)
+            while True:
+                chunk = await next_chunk()
+                if not chunk:
+                    return
+                for record in chunk:
+                    yield record
+
+        return generator()
+
 
 class GenericUserProfileQuerySet(QuerySet):
     """
@@ -109,6 +145,50 @@ class GenericUserProfileQuerySet(QuerySet):
         self._validate_iterator()
         return super().iterator()
 
+    def aiterator(self, chunk_size: int=2000) -> AsyncIterator[Model]:
+        """
+        Async equivalent of iterator(): streams records (or profiles) without caching them
+
+        As with iterator(), prefetch_related() lookups are ignored
+        """
+        if chunk_size <= 0:
+            raise ValueError('Chunk size must be strictly positive.')
+        self._validate_iterator()
+        use_chunked_fetch = not connections[self.db].settings_dict.get('DISABLE_SERVER_SIDE_CURSORS')
+        return self._iterable_class(self, chunked_fetch=use_chunked_fetch, chunk_size=chunk_size).__aiter__()
+
+    def __aiter__(self) -> AsyncIterator[Model]:
+        """
+        Allows `async for` over the queryset
+
+        Records are fetched in batches; if there are prefetch_related() lookups (or values()/values_list() has been
+        used) then all records are fetched at once so that the prefetches are done
+
+        As with sync iteration the results are cached, so iterating an already evaluated queryset (or iterating
+        again) doesn't query again
+        """
+        # imported here so that asgiref is only required if async iteration is used
+        from asgiref.sync import sync_to_async
+
+        if self._result_cache is None and not self._prefetch_related_lookups \
+                and issubclass(self._iterable_class, GenericUserProfileIterable):
+            async def chunked_generator():
+                results = []
+                async for record in self._iterable_class(self).__aiter__():
+                    results.append(record)
+                    yield record
+                if self._result_cache is None:
+                    self._result_cache = results
+
+            return chunked_generator()
+
+        async def generator():
+            await sync_to_async(self._fetch_all, thread_sensitive=True)()
+            for record in self._result_cache:
+                yield record
+
+        return generator()
+
 
 def _is_profile(model: Type[Model]) -> bool:
     """
@@ -122,6 +202,61 @@ def _is_profile(model: Type[Model]) -> bool:
     return bool(model._meta.parents)
 
 
+def _resolve_relation_path(model: Type[Model], path: str) -> Tuple[bool, Type[Model], str]:
+    """
+    Follow a relation path (eg 'order__created_by') from model
+
+    :return: (
+        whether the path traverses a one-to-many or many-to-many relation,
+        the model at the end of the path,
+        the path using attribute names (as needed by prefetch_related() for reverse relations),
+    )
+    """
+    is_multivalued = False
+    attr_names = []
+    for field_name in path.split('__'):
+        field = model._meta.get_field(field_name)
+        if not field.is_relation:
+            raise ValueError(f"'{path}' is not a relation path from {model._meta.label}")
+        is_multivalued = is_multivalued or field.one_to_many or field.many_to_many
+        attr_names.append(field.get_accessor_name() if isinstance(field, ForeignObjectRel) else field.name)
+        model = field.related_model
+    return is_multivalued, model, '__'.join(attr_names)
+
+
+def _query_param_batches(model: Type[Model], values: List, reserved_params: int=0) -> Iterable[List]:
+    """
+    Split values into batches that can be used in an `__in` lookup without exceeding the database's
+    limit on query parameters (if any)
+    """
+    max_query_params = connections[router.db_for_read(model)].features.max_query_params
+    batch_size = max(1, max_query_params - reserved_params) if max_query_params else max(1, len(values))
+    for i in range(0, len(values), batch_size):
+        yield values[i:i + batch_size]
+
+
+def _bulk_create_users(user_model: Type[Model], users: List[Model], batch_size: Optional[int], db: str):
+    """
+    bulk_create() users and ensure that they all have their pk set
+    """
+    user_model._base_manager.using(db).bulk_create(users, batch_size=batch_size)
+
+    if any(user.pk is None for user in users):
+        # database can't return pks from a bulk insert; emails are unique so use those instead
+        email_pks = {}
+        for batch in _query_param_batches(user_model, [user.email for user in users]):
+            qs = user_model._base_manager.using(db).filter(email__in=batch)
+            email_pks.update(qs.values_list('email', 'pk'))
+        for user in users:
+            user.pk = email_pks[user.email]
+
+
+def _set_saved_state(objs: Iterable[Model], db: str):
+    for obj in objs:
+        obj._state.adding = False
+        obj._state.db = db
+
+
 # Concrete models with a GenericUserProfileManagerMixin must define related_profile_tables
 def _validate_related_profile_tables(model: Type[Model], manager_name: str):
     # , model_app_name: Tuple[str, str],
@@ -199,31 +334,161 @@ class GenericUserProfileManagerMixin(BaseUserManager):
     def profiles(self) -> QuerySet:
         return self.get_queryset().profiles()
 
+    def bulk_create_profiles(self, objs: Iterable[Model], batch_size: Optional[int]=None) -> List[Model]:
+        """
+        Equivalent of bulk_create() that also works for profile models
+
+        django's bulk_create() doesn't support multi-table inheritance; this inserts the user records in bulk,
+        retrieves their pks (from the INSERT if the database supports it, otherwise by looking up the unique
+        emails) and then inserts the profile records in bulk. Emails are normalized as they would be by save().
+
+        As with bulk_create(), save() is not called and no signals are sent.
+
+        Only a single level of multi-table inheritance (ie User -> Profile) is supported.
+        """
+        objs = list(objs)
+        for obj in objs:
+            obj.email = obj.normalize_email(obj.email)
+
+        db = router.db_for_write(self.model)
+
+        if not _is_profile(self.model):
+            with transaction.atomic(using=db, savepoint=False):
+                _bulk_create_users(self.model, objs, batch_size, db)
+            _set_saved_state(objs, db)
+            return objs
+
+        parents = self.model._meta.parents
+        if len(parents) != 1 or _is_profile(next(iter(parents))):
+            raise ValueError('bulk_create_profiles() only supports a single level of multi-table inheritance')
+        (user_model, parent_link), = parents.items()
+
+        user_fields = user_model._meta.concrete_fields
+        profile_fields = self.model._meta.local_concrete_fields
+
+        with transaction.atomic(using=db, savepoint=False):
+            users = [user_model(**{f.attname: getattr(obj, f.attname) for f in user_fields}) for obj in objs]
+            _bulk_create_users(user_model, users, batch_size, db)
+
+            for obj, user in zip(objs, users):
+                for field in user_fields:
+                    setattr(obj, field.attname, getattr(user, field.attname))
+                setattr(obj, parent_link.attname, user.pk)
+
+            max_batch_size = max(connections[db].ops.bulk_batch_size(profile_fields, objs), 1)
+            batch_size = min(batch_size, max_batch_size) if batch_size else max_batch_size
+            queryset = self.model._base_manager.using(db)
+            for i in range(0, len(objs), batch_size):
+                queryset._insert(objs[i:i + batch_size], fields=profile_fields, using=db)
+
+        _set_saved_state(objs, db)
+        return objs
+
+    def bulk_update_profiles(self, objs: Iterable[Model], fields: Iterable[str], batch_size: Optional[int]=None):
+        """
+        Equivalent of bulk_update() that normalizes emails as they would be by save()
+        """
+        objs = list(objs)
+        fields = list(fields)
+        if 'email' in fields:
+            for obj in objs:
+                obj.email = obj.normalize_email(obj.email)
+        return self.bulk_update(objs, fields, batch_size=batch_size)
+
     # TODO: It would be nice to be able to do something like:
     #   SomeModel.objects.select_related('user__profile')
     # and have the '__profile' transformed into the relevant select_related() based on model.related_profile_tables
     # unfortunately the code to do the joins is baked into SQLCompiler.get_related_selections() and is not really
     # extensible without being very invasive
     #
-    # Instead we have to call select_related_profiles on an unrelated queryset with a prefix
+    # Instead we have to call select_related_profiles on an unrelated queryset with a prefix (or multiple prefixes)
 
-    def select_related_profiles(self, queryset: Optional[Union[QuerySet, Manager]]=None, prefix: str='') -> QuerySet:
-        if bool(queryset) != bool(prefix):
+    def _get_profile_lookups(self, prefix: Union[str, Iterable[str]]) -> List[str]:
+        """
+        Expand one or more relation paths into the (deduplicated) lookups needed to reach each profile table
+        """
+        prefixes = [prefix] if isinstance(prefix, str) else prefix
+        return list(dict.fromkeys(
+            p + '__' + profile
+            for p in prefixes
+            for profile in self.model.related_profile_tables
+        ))
+
+    def select_related_profiles(
+            self,
+            queryset: Optional[Union[QuerySet, Manager]]=None,
+            prefix: Union[str, Iterable[str]]='',
+    ) -> QuerySet:
+        # note that bool(queryset) would evaluate the queryset
+        if (queryset is None) != (not prefix):
             raise ValueError('Either none or both of queryset and prefix must be specified')
 
-        if not queryset and not prefix:
+        if queryset is None:
             return self.get_queryset().select_related_profiles()
         else:
-            return queryset.select_related(*[prefix + '__' + profile for profile in self.model.related_profile_tables])
-
-    def prefetch_related_profiles(self, queryset: Optional[Union[QuerySet, Manager]]=None, prefix: str='') -> QuerySet:
-        if bool(queryset) != bool(prefix):
+            return queryset.select_related(*self._get_profile_lookups(prefix))
+
+    def prefetch_related_profiles(
+            self,
+            queryset: Optional[Union[QuerySet, Manager]]=None,
+            prefix: Union[str, Iterable[str]]='',
+    ) -> QuerySet:
+        # note that bool(queryset) would evaluate the queryset
+        if (queryset is None) != (not prefix):
             raise ValueError('Either none or both of queryset and prefix must be specified')
 
-        if not queryset and not prefix:
+        if queryset is None:
             return self.get_queryset().prefetch_related_profiles()
         else:
-            return queryset.prefetch_related(*[prefix + '__' + profile for profile in self.model.related_profile_tables])
+            return queryset.prefetch_related(*self._get_profile_lookups(prefix))
+
+    def related_profiles(
+            self,
+            queryset: Union[QuerySet, Manager],
+            *paths: str,
+            prefetch: Optional[bool]=None,
+    ) -> QuerySet:
+        """
+        Adds the joins or prefetches needed so that the users at the end of each of paths can resolve their profile
+        without extra queries
+
+        Duplicate paths are ignored. Paths that end at a profile model rather than the user model need no
+        profile tables and are only joined/prefetched themselves.
+
+        :param queryset: queryset (of any model) to add the joins/prefetches to
+        :param paths: relation paths from queryset.model to the user model, eg 'order__created_by'
+        :param prefetch: True to always prefetch, False to always join. If None then paths that only traverse
+            single-valued relations are joined and paths that traverse a one-to-many or many-to-many relation
+            (and so can't be joined) are prefetched with the profile tables joined in the prefetch query
+        """
+        queryset = queryset.all()
+        select_lookups = []
+        prefetch_lookups = []
+        for path in dict.fromkeys(paths):
+            is_multivalued, related_model, attr_path = _resolve_relation_path(queryset.model, path)
+            if not issubclass(related_model, GenericUserProfile):
+                raise ValueError(f"'{path}' does not refer to a GenericUserProfile ({related_model._meta.label})")
+            if is_multivalued and prefetch is False:
+                raise ValueError(f"'{path}' traverses a multi-valued relation and can't be joined")
+
+            related_tables = [] if _is_profile(related_model) else related_model.related_profile_tables
+
+            if is_multivalued if prefetch is None else prefetch:
+                prefetch_queryset = related_model._base_manager.all()
+                if related_tables:
+                    # a bare select_related() would join every non-null FK
+                    prefetch_queryset = prefetch_queryset.select_related(*related_tables)
+                prefetch_lookups.append(Prefetch(attr_path, queryset=prefetch_queryset))
+            elif related_tables:
+                select_lookups.extend(path + '__' + profile for profile in related_tables)
+            else:
+                select_lookups.append(path)
+
+        if select_lookups:
+            queryset = queryset.select_related(*dict.fromkeys(select_lookups))
+        if prefetch_lookups:
+            queryset = queryset.prefetch_related(*prefetch_lookups)
+        return queryset
 
 
 class GenericUserProfileManager(GenericUserProfileManagerMixin, UserManager):
@@ -233,6 +498,36 @@ class GenericUserProfileManager(GenericUserProfileManagerMixin, UserManager):
     pass
 
 
+class DuplicateEmails(NamedTuple):
+    # normalized emails that appear more than once in the batch
+    in_batch: Set[str]
+    # normalized emails that already belong to another record in the database
+    in_database: Set[str]
+
+
+class profile_identity_map(ScopedContext):
+    """
+    Context manager that shares resolved profiles between all user/profile records with the same pk
+
+    Within the context, the first time a user's profile is resolved (via `.profile`) it is recorded; any other
+    user or profile record with the same pk (eg the same user referenced by multiple FKs, or loaded by a
+    separate prefetch) will then return that same profile object without querying the profile tables again.
+
+    Nested contexts share the outermost context's map. Changes made to the database by other means during
+    the context will not be reflected in already-resolved profiles.
+    """
+    context_var = make_context_var('profile_identity_map')
+
+    def create(self) -> Dict[Tuple[Type[Model], Any], Model]:
+        return {}
+
+
+def _identity_map_key(record: Model) -> Tuple[Type[Model], Any]:
+    # key on the root of the multi-table inheritance chain so that user & profile records share the same key
+    parents = record._meta.get_parent_list()
+    return (parents[-1] if parents else record._meta.concrete_model, record.pk)
+
+
 class GenericUserProfile(Model):
     """
     A User model that provides iteration over user profiles (if available)
@@ -248,8 +543,38 @@ class GenericUserProfile(Model):
     def normalize_email(cls, email):
         return email.lower()
 
+    @classmethod
+    def find_duplicate_emails(cls, emails: Iterable[str], exclude_pks: Iterable=()) -> DuplicateEmails:
+        """
+        Check a batch of emails for uniqueness (eg when bulk importing users)
+
+        Emails are normalized before comparison. The database is checked with a single query (or one query
+        per batch if the database limits the number of query parameters) on LOWER(email) so that existing
+        mixed-case records are found and the index recommended by check_user_email_index() can be used.
+
+        :param emails: emails to check
+        :param exclude_pks: pks of existing records to ignore (ie records that the emails will be saved to)
+        """
+        normalized = [cls.normalize_email(email) for email in emails]
+        # excluded in python rather than the query so that any number of pks can be excluded
+        exclude_pks = {pk for pk in exclude_pks if pk is not None}
+
+        seen = set()
+        in_batch = set()
+        for email in normalized:
+            if email in seen:
+                in_batch.add(email)
+            seen.add(email)
+
+        in_database = set()
+        for batch in _query_param_batches(cls, list(seen)):
+            qs = cls._base_manager.annotate(email_lower=Lower('email')).filter(email_lower__in=batch)
+            in_database.update(email for email, pk in qs.values_list('email_lower', 'pk') if pk not in exclude_pks)
+
+        return DuplicateEmails(in_batch=in_batch, in_database=in_database)
+
     def clean(self):
-        if self.__class__._base_manager.filter(email=self.__class__.normalize_email(self.email)).exclude(pk=self.pk).exists():
+        if self.__class__.find_duplicate_emails([self.email], exclude_pks=[self.pk]).in_database:
             raise ValidationError({'email': 'Sorry, this email address is not available.'})
 
     def save(self, *args, **kwargs):
@@ -281,7 +606,19 @@ class GenericUserProfile(Model):
             if obj is None:
                 return self
 
+            profiles = profile_identity_map.get_current()
+            key = _identity_map_key(obj) if profiles is not None and obj.pk is not None else None
+
+            # another record with the same pk has already resolved its profile
+            # (a profile record is its own profile so is never replaced by another instance)
+            if key is not None and key in profiles and not _is_profile(obj):
+                user_profile = profiles[key]
+                obj.__dict__['profile'] = user_profile
+                return user_profile
+
             user_profile = obj.get_profile()
+            if key is not None:
+                profiles.setdefault(key, user_profile)
 
             # cache the result on all records in the multi-table inheritance chain
             record = user_profile
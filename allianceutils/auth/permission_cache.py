@@ -0,0 +1,99 @@
+import time
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import Optional
+from typing import Tuple
+
+from django.db.models import Model
+
+from allianceutils.auth.permission_profile import is_profiling
+from allianceutils.auth.permission_profile import record_permission_check
+from allianceutils.util.scoped_context import make_context_var
+from allianceutils.util.scoped_context import ScopedContext
+
+
+class permission_cache(ScopedContext):
+    """
+    Context manager that memoizes permission checks made via cached_has_perm() / cached_has_perms()
+
+    Within the context each (user, permission, object) combination is only checked once; later checks return the
+    recorded result. Users and objects are matched by identity (not pk): a record that is loaded again is a
+    different object and so is checked again, but changes made to an object that has already been checked are not
+    noticed. Call clear_permission_cache() after modifying an object (eg after serializer.save()) if its permissions
+    may have changed.
+
+    Nested contexts share the outermost context's cache. If permissions change during the context (eg a user is
+    added to a group) call clear_permission_cache() so that they are checked again.
+    """
+    context_var = make_context_var('permission_cache')
+
+    def create(self) -> Dict[Tuple[int, str, int], Tuple[Model, Any, bool]]:
+        return {}
+
+
+def clear_permission_cache():
+    """
+    Forget all permission checks recorded by the active permission_cache() context (if any)
+    """
+    decisions = permission_cache.get_current()
+    if decisions is not None:
+        decisions.clear()
+
+
+def get_cached_decision(user: Model, perm: str, obj: Optional[Model] = None) -> Optional[bool]:
+    """
+    Get the result of a permission check recorded by the active permission_cache() context
+
+    :return: the recorded result, or None if there is no active context or the check hasn't been recorded
+    """
+    decisions = permission_cache.get_current()
+    if decisions is None:
+        return None
+    decision = decisions.get((id(user), perm, id(obj)))
+    return None if decision is None else decision[2]
+
+
+def record_decision(user: Model, perm: str, obj: Optional[Model], result: bool):
+    """
+    Record the result of a permission check in the active permission_cache() context (if any)
+    """
+    decisions = permission_cache.get_current()
+    if decisions is not None:
+        # user & obj are kept so that their ids can't be reused by other objects while the context is active
+        decisions[(id(user), perm, id(obj))] = (user, obj, result)
+
+
+def cached_has_perm(user: Model, perm: str, obj: Optional[Model] = None) -> bool:
+    """
+    user.has_perm(perm, obj), memoized for the duration of the active permission_cache() context
+
+    If there is no active context then this is equivalent to user.has_perm(perm, obj). The result is not rechecked
+    if obj is later modified; see permission_cache()
+
+    Checks are recorded by the active permission_profile() context (if any)
+    """
+    if is_profiling():
+        start = time.perf_counter()
+        result = get_cached_decision(user, perm, obj)
+        cached = result is not None
+        if not cached:
+            result = user.has_perm(perm, obj)
+            record_decision(user, perm, obj, result)
+        record_permission_check(perm, obj is not None, time.perf_counter() - start, cached)
+        return result
+
+    result = get_cached_decision(user, perm, obj)
+    if result is None:
+        result = user.has_perm(perm, obj)
+        record_decision(user, perm, obj, result)
+    return result
+
+
+def cached_has_perms(user: Model, perms: Iterable[str], obj: Optional[Model] = None) -> bool:
+    """
+    user.has_perms(perms, obj), memoized for the duration of the active permission_cache() context
+    """
+    if permission_cache.get_current() is None and not is_profiling():
+        return user.has_perms(perms, obj)
+    return all(cached_has_perm(user, perm, obj) for perm in perms)
@@ -0,0 +1,79 @@
+from typing import Dict
+
+from allianceutils.util.scoped_context import make_context_var
+from allianceutils.util.scoped_context import ScopedContext
+
+
+class PermissionStats:
+    """
+    Permission checks recorded for a single permission
+    """
+    global_calls: int
+    object_calls: int
+    # checks answered by permission_cache() without calling the backends
+    cached_calls: int
+    # seconds spent in checks (including nested checks made by rules predicates)
+    global_time: float
+    object_time: float
+
+    def __init__(self):
+        self.global_calls = 0
+        self.object_calls = 0
+        self.cached_calls = 0
+        self.global_time = 0.0
+        self.object_time = 0.0
+
+    @property
+    def calls(self) -> int:
+        return self.global_calls + self.object_calls
+
+    @property
+    def time(self) -> float:
+        return self.global_time + self.object_time
+
+    def __repr__(self):
+        return (
+            f'<PermissionStats calls={self.calls} global={self.global_calls} object={self.object_calls} '
+            f'cached={self.cached_calls} time={self.time:.6f}>'
+        )
+
+
+class permission_profile(ScopedContext):
+    """
+    Context manager that records the number of checks & time spent on each permission
+
+    Checks made via allianceutils.auth.permission_cache.cached_has_perm() & cached_has_perms() are recorded; this
+    includes the DRF permission classes in allianceutils.api.permissions and the allianceutils.rules predicates.
+
+    Nested contexts share the outermost context's stats.
+    """
+    context_var = make_context_var('permission_profile')
+
+    def create(self) -> Dict[str, PermissionStats]:
+        return {}
+
+
+def is_profiling() -> bool:
+    return permission_profile.get_current() is not None
+
+
+def record_permission_check(perm: str, is_object: bool, elapsed: float, cached: bool = False):
+    """
+    Record a permission check in the active permission_profile() context (if any)
+    """
+    stats = permission_profile.get_current()
+    if stats is None:
+        return
+    try:
+        perm_stats = stats[perm]
+    except KeyError:
+        perm_stats = stats[perm] = PermissionStats()
+
+    if is_object:
+        perm_stats.object_calls += 1
+        perm_stats.object_time += elapsed
+    else:
+        perm_stats.global_calls += 1
+        perm_stats.global_time += elapsed
+    if cached:
+        perm_stats.cached_calls += 1
@@ -17,6 +17,8 @@ from django.apps.config import AppConfig
 from django.conf import settings
 from django.core.checks import Error
 from django.core.checks import Warning
+from django.db import connections
+from django.db import router
 from django.db.models import Model
 from django.urls import get_resolver
 
@@ -44,6 +46,8 @@ ID_ERROR_GIT_HOOKS = 'allianceutils.E008'
 ID_ERROR_EXPLICIT_TABLE_NAME = 'allianceutils.E009'
 ID_ERROR_EXPLICIT_TABLE_NAME_LOWERCASE = 'allianceutils.E010'
 ID_ERROR_FIELD_NAME_NOT_CAMEL_FRIENDLY = 'allianceutils.E011'
+ID_WARNING_USER_EMAIL_INDEX = 'allianceutils.W012'
+ID_WARNING_VIEWSET_ACTION_PERMISSIONS = 'allianceutils.W013'
 
 
 def find_candidate_models(
@@ -260,6 +264,98 @@ def check_db_constraints(app_configs: Iterable[AppConfig], **kwargs):
 
     return errors
 
+
+def check_user_email_index(app_configs: Iterable[AppConfig], **kwargs):
+    """
+    If the user model is a GenericUserProfile on postgresql, check that there is a functional index
+    on LOWER(email) (or UPPER(email)) so that case-insensitive email lookups don't need a full table scan.
+
+    mysql's default collations are already case-insensitive so a plain index on email is sufficient there.
+    """
+    # imported here to avoid a circular import & so that this module can be used without django.contrib.auth
+    from django.contrib.auth import get_user_model
+
+    from allianceutils.auth.models import GenericUserProfile
+
+    user_model = get_user_model()
+    if not issubclass(user_model, GenericUserProfile):
+        return []
+
+    connection = connections[router.db_for_read(user_model)]
+    if connection.vendor != 'postgresql':
+        return []
+
+    table = user_model._meta.db_table
+    column = user_model._meta.get_field('email').column
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, table)
+
+    # postgres index definitions look like: CREATE INDEX ... USING btree (lower((email)::text))
+    index_re = re.compile(r'\b(lower|upper)\(+"?%s"?\b' % re.escape(column), re.IGNORECASE)
+    if any(index_re.search(constraint.get('definition') or '') for constraint in constraints.values()):
+        return []
+
+    return [
+        Warning(
+            f'{user_model._meta.label} has no functional index on LOWER({column})',
+            hint=(
+                f'Case-insensitive email lookups will scan the whole table; '
+                f'add an index with CREATE INDEX ... ON {table} (LOWER({column})) '
+                f'(or UPPER({column}::text), which is what django\'s iexact lookup uses on postgresql)'
+            ),
+            obj=user_model,
+            id=ID_WARNING_USER_EMAIL_INDEX,
+        )
+    ]
+
+
+def check_viewset_permission_tables(app_configs: Iterable[AppConfig], **kwargs):
+    """
+    Build the GenericDjangoViewsetPermissions permission table for every routed viewset at startup (rather than
+    on the first request to each viewset) and warn about viewset actions that have no permissions mapping
+    (these would raise ImproperlyConfigured when requested)
+    """
+    # imported here so that this module can be used without rest_framework
+    from allianceutils.api.permissions import GenericDjangoViewsetPermissions
+
+    def iter_viewset_callbacks(resolver: URLResolver):
+        for url_pattern in resolver.url_patterns:
+            if hasattr(url_pattern, 'url_patterns'):
+                yield from iter_viewset_callbacks(url_pattern)
+            elif getattr(url_pattern.callback, 'actions', None):
+                yield url_pattern.callback
+
+    warnings = []
+    seen = set()
+    for callback in iter_viewset_callbacks(get_resolver()):
+        viewset_class = callback.cls
+        permission_classes = callback.initkwargs.get('permission_classes', viewset_class.permission_classes)
+        for permission_class in permission_classes:
+            if not (inspect.isclass(permission_class) and issubclass(permission_class, GenericDjangoViewsetPermissions)):
+                continue
+            permission = permission_class()
+            permission.get_permission_table(viewset_class)
+
+            if type(permission).get_permissions_for_action is not GenericDjangoViewsetPermissions.get_permissions_for_action:
+                # can't tell which actions a custom implementation handles
+                continue
+            actions_to_perms_map = permission.get_actions_to_perms_map()
+            for action in callback.actions.values():
+                if action not in actions_to_perms_map and (viewset_class, permission_class, action) not in seen:
+                    seen.add((viewset_class, permission_class, action))
+                    warnings.append(
+                        Warning(
+                            f'{viewset_class.__module__}.{viewset_class.__qualname__} action {action} '
+                            f'has no permissions in {permission_class.__qualname__}.actions_to_perms_map',
+                            hint='Requests to this action will raise ImproperlyConfigured',
+                            obj=viewset_class,
+                            id=ID_WARNING_VIEWSET_ACTION_PERMISSIONS,
+                        )
+                    )
+
+    return warnings
+
+
 def _check_explicit_table_names_on_model(model: Type[Model], enforce_lowercase: bool) -> Iterable[Type[Error]]:
     """
     Use an ast to check if a model has the db_table meta option set.
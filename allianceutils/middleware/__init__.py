@@ -1,9 +1,17 @@
 from .current_user import CurrentUserMiddleware
 from .http_auth import HttpAuthMiddleware
+from .performance_budget import PerformanceBudgetMiddleware
+from .permission_cache import PermissionCacheMiddleware
+from .permission_profile import PermissionProfileMiddleware
+from .profile_identity_map import ProfileIdentityMapMiddleware
 from .query_count import QueryCountMiddleware
 
 __all__ = [
     'HttpAuthMiddleware',
     'CurrentUserMiddleWare',
+    'PerformanceBudgetMiddleware',
+    'PermissionCacheMiddleware',
+    'PermissionProfileMiddleware',
+    'ProfileIdentityMapMiddleware',
     'QueryCountMiddleware',
 ]
@@ -1,24 +1,107 @@
+import asyncio
+from concurrent.futures import Executor
+from concurrent.futures import Future
+import functools
 import threading
+from typing import Callable
+from typing import Dict
+from typing import Optional
 
-from django.utils.deprecation import MiddlewareMixin
+from django.http import HttpRequest
+from django.http import HttpResponse
+from django.utils.functional import empty
+from django.utils.functional import LazyObject
 
-GLOBAL_USER = threading.local()
+from allianceutils.util.async_utils import mark_coroutine_function
+from allianceutils.util.scoped_context import make_context_var
 
-class CurrentUserMiddleware(MiddlewareMixin):
+try:
+    import contextvars
+except ImportError:
+    # python 3.6
+    contextvars = None
+
+
+class _LazyCurrentUser:
+    """
+    Resolves the request's user only when first needed: reading request.user.id forces the auth backend to load the
+    user, which is wasted work for requests that never call CurrentUserMiddleware.get_user()
+    """
+    request: HttpRequest
+    user: Optional[Dict[str, Optional[object]]]
+
+    def __init__(self, request: HttpRequest):
+        self.request = request
+        self.user = None
+
+    def resolve(self) -> Dict[str, Optional[object]]:
+        if self.user is None:
+            user = self.request.user
+            self.user = {
+                'user_id': user.id if user is not None else None,
+                'remote_ip': self.request.META.get('REMOTE_ADDR'),
+            }
+        return self.user
+
+
+# {'user_id': ..., 'remote_ip': ...} or a _LazyCurrentUser for the current request
+_current_user = make_context_var('current_user')
 
-    def __init__(self, get_response=None):
-        self.get_response = get_response
 
+class CurrentUserMiddleware:
     """
     Middleware to enable accessing the currently logged-in user without
     a request object.
+
+    The user is stored in a context variable so this works as either sync or async middleware (django 3.1+); use
+    copy_context_callable() or submit_with_context() to make the user available to work done in other threads.
+
+    Sync requests load the user lazily, when get_user() is first called; async requests load it before the rest of
+    the request is run, as loading the user from a coroutine isn't allowed.
     """
-    def process_request(self, request):
+    sync_capable = True
+    async_capable = True
+
+    get_response: Callable
+    is_async: bool
+
+    def __init__(self, get_response: Callable):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            mark_coroutine_function(self)
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        if self.is_async:
+            return self.__acall__(request)
+
+        token = self.process_request(request)
+        try:
+            return self.get_response(request)
+        finally:
+            _current_user.reset(token)
+
+    async def __acall__(self, request: HttpRequest) -> HttpResponse:
+        token = self.process_request(request)
+        try:
+            user = request.user
+            if isinstance(user, LazyObject) and user._wrapped is empty:
+                # get_user() is sync & may be called from a coroutine, where loading the user from the session
+                # would raise SynchronousOnlyOperation, so async requests load the user up front in a thread
+                # imported here so that asgiref is only required if used as async middleware
+                from asgiref.sync import sync_to_async
+                await sync_to_async(_current_user.get().resolve, thread_sensitive=True)()
+            return await self.get_response(request)
+        finally:
+            _current_user.reset(token)
+
+    def process_request(self, request: HttpRequest):
         """
-        Loads the user record for the currently logged in user and adjusts the scope security based on
-        that user
+        Records the currently logged in user for the duration of the request
+
+        The user isn't loaded until get_user() is called
         :param request: The current request
-        :return None
+        :return token to restore the previous user with
         """
         assert hasattr(request, 'user'), (
             u"The CurrentUser middleware requires the authentication middleware "
@@ -27,33 +110,60 @@ class CurrentUserMiddleware(MiddlewareMixin):
             u"'%s.CurrentUserMiddleware'." % __name__
         )
 
-        if request.user is not None:
-            CurrentUserMiddleware._set_user(request.user.id, request.META.get('REMOTE_ADDR'))
-        else:
-            CurrentUserMiddleware._set_user(None, request.META.get('REMOTE_ADDR'))
-
-    def process_response(self, request, response):
-        CurrentUserMiddleware._del_user()
-        return response
-
-    def process_exception(self, request, exception):
-        CurrentUserMiddleware._del_user()
+        return _current_user.set(_LazyCurrentUser(request))
 
     @classmethod
     def _set_user(cls, user_id, remote_ip):
-        GLOBAL_USER.user = {
+        _current_user.set({
             'user_id': user_id,
             'remote_ip': remote_ip,
-        }
+        })
 
     @classmethod
-    def get_user(cls):
-        thread_id = threading.current_thread().ident
-        try:
-            return GLOBAL_USER.user
-        except AttributeError:
+    def get_user(cls) -> Dict[str, Optional[object]]:
+        user = _current_user.get()
+        if user is None:
+            thread_id = threading.current_thread().ident
             raise KeyError('Thread {} not already registered with CurrentUserMiddleware.'.format(thread_id))
+        if isinstance(user, _LazyCurrentUser):
+            return user.resolve()
+        return user
 
     @classmethod
     def _del_user(cls):
-        del GLOBAL_USER.user
+        _current_user.set(None)
+
+
+def copy_context_callable(fn: Callable) -> Callable:
+    """
+    Wrap fn so that it runs with the caller's current user (and, on python 3.7+, all other context variables) when
+    called from another thread, eg in a ThreadPoolExecutor
+
+    The context is captured when copy_context_callable() is called, not when fn is
+    """
+    if contextvars is None:
+        user = _current_user.get()
+
+        @functools.wraps(fn)
+        def run_with_user(*args, **kwargs):
+            token = _current_user.set(user)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _current_user.reset(token)
+        return run_with_user
+
+    context = contextvars.copy_context()
+
+    @functools.wraps(fn)
+    def run_in_context(*args, **kwargs):
+        # a context can only be entered by one thread at a time, so each call gets its own copy
+        return context.copy().run(fn, *args, **kwargs)
+    return run_in_context
+
+
+def submit_with_context(executor: Executor, fn: Callable, *args, **kwargs) -> Future:
+    """
+    executor.submit(fn, *args, **kwargs) with fn wrapped by copy_context_callable()
+    """
+    return executor.submit(copy_context_callable(fn), *args, **kwargs)
@@ -1,33 +1,74 @@
 import base64
+import hashlib
+import hmac
+import re
+from typing import Callable
+from typing import List
+from typing import Optional
+from typing import Pattern
 
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.http import HttpRequest
 from django.http import HttpResponse
 
+HTTP_AUTH_SETTINGS = ('HTTP_AUTH_USERNAME', 'HTTP_AUTH_PASSWORD', 'HTTP_AUTH_EXEMPT_PATHS')
+
 
 class HttpAuthMiddleware:
+    """
+    The expected credentials are read from settings once (and again if they change) and stored as a digest so that
+    each request only has to hash & compare the Authorization header
+    """
+    get_response: Callable
+    # whether http auth is enabled (ie HTTP_AUTH_USERNAME is set)
+    enabled: bool
+    # sha256 of the expected base64 credentials, or None if no credentials are accepted
+    expected_digest: Optional[bytes]
+    exempt_paths: List[Pattern]
+
     def __init__(self, get_response):
         self.get_response = get_response
+        self.load_settings()
+        setting_changed.connect(self.setting_changed)
+
+    def load_settings(self):
+        auth_username = getattr(settings, 'HTTP_AUTH_USERNAME', None)
+        auth_password = getattr(settings, 'HTTP_AUTH_PASSWORD', None)
+        self.enabled = bool(auth_username)
+        if auth_username and auth_password is not None:
+            credentials = base64.b64encode(f'{auth_username}:{auth_password}'.encode('utf-8'))
+            self.expected_digest = hashlib.sha256(credentials).digest()
+        else:
+            # a username without a password rejects every request rather than accepting an empty password
+            self.expected_digest = None
+        self.exempt_paths = [re.compile(pattern) for pattern in getattr(settings, 'HTTP_AUTH_EXEMPT_PATHS', [])]
+
+    def setting_changed(self, setting: str, **kwargs):
+        if setting in HTTP_AUTH_SETTINGS:
+            self.load_settings()
 
     def __unauthorized(self):
         response = HttpResponse('You are not authorized to view this resource.', status=401)
         response['WWW-Authenticate']='Basic realm="restricted"'
         return response
 
-    def __call__(self, request):
-        auth_username = getattr(settings,'HTTP_AUTH_USERNAME',None)
-        if not auth_username:
-            return self.get_response(request)
-        auth_password = getattr(settings,'HTTP_AUTH_PASSWORD',None)
-
-        environ = request.environ
-        authorization = environ.get('HTTP_AUTHORIZATION', None)
-        if not authorization:
-            return self.__unauthorized()
+    def is_exempt(self, request: HttpRequest) -> bool:
+        path = request.path.lstrip('/')
+        return any(pattern.search(path) for pattern in self.exempt_paths)
 
-        (method, authentication) = authorization.split(' ', 1)
-        if 'basic' == method.lower():
-            request_username, request_password = str(base64.b64decode(authentication.strip()), 'utf-8').split(':', 1)
-            if auth_username == request_username and auth_password == request_password:
-                return self.get_response(request)
+    def is_authorized(self, request: HttpRequest) -> bool:
+        authorization = request.META.get('HTTP_AUTHORIZATION')
+        if not authorization or self.expected_digest is None:
+            return False
+        method, _, credentials = authorization.partition(' ')
+        if method.lower() != 'basic':
+            return False
+        # hashing first means compare_digest() doesn't leak the length of the expected credentials
+        digest = hashlib.sha256(credentials.strip().encode('utf-8')).digest()
+        return hmac.compare_digest(digest, self.expected_digest)
 
+    def __call__(self, request):
+        if not self.enabled or self.is_exempt(request) or self.is_authorized(request):
+            return self.get_response(request)
         return self.__unauthorized()
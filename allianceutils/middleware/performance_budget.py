@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import time
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpRequest
+from django.http import HttpResponse
+
+from allianceutils.middleware.query_count import context_query_counter
+from allianceutils.middleware.query_count import DEFAULT_QUERY_COUNT_WARNING_THRESHOLD
+from allianceutils.middleware.query_count import install_context_query_counter
+from allianceutils.middleware.query_count import QueryCounter
+from allianceutils.util.async_utils import mark_coroutine_function
+
+try:
+    import contextvars
+except ImportError:
+    # python 3.6
+    contextvars = None
+
+logger = logging.getLogger('django.request')
+
+
+class PerformanceBudget(NamedTuple):
+    """
+    Limits for a single request; None means no limit. Times are in seconds, response_size is in bytes.
+    """
+    queries: Optional[int] = None
+    db_time: Optional[float] = None
+    time: Optional[float] = None
+    response_size: Optional[int] = None
+
+
+class PerformanceBudgetExceeded(AssertionError):
+    """
+    Raised instead of logging a warning when settings.PERFORMANCE_BUDGET_STRICT is set (eg in tests)
+
+    This is an AssertionError so that test runners report it as a failure
+    """
+    pass
+
+
+def get_budget_from_settings(view_name: Optional[str]) -> Optional[PerformanceBudget]:
+    budgets = getattr(settings, 'PERFORMANCE_BUDGETS', {})
+    budget = budgets.get(view_name) if view_name is not None else None
+    if budget is None:
+        budget = getattr(settings, 'PERFORMANCE_BUDGET_DEFAULT', None)
+    if budget is None or isinstance(budget, PerformanceBudget):
+        return budget
+    return PerformanceBudget(**budget)
+
+
+def get_budget_violations(
+    budget: PerformanceBudget,
+    counter: QueryCounter,
+    elapsed: float,
+    response_size: Optional[int],
+) -> List[str]:
+    violations = []
+    if budget.queries is not None and counter.count > budget.queries:
+        violations.append(f'ran {counter.count} queries (budget {budget.queries})')
+    if budget.db_time is not None and counter.time > budget.db_time:
+        violations.append(f'spent {counter.time * 1000:.1f}ms in the database (budget {budget.db_time * 1000:.1f}ms)')
+    if budget.time is not None and elapsed > budget.time:
+        violations.append(f'took {elapsed * 1000:.1f}ms (budget {budget.time * 1000:.1f}ms)')
+    if budget.response_size is not None and response_size is not None and response_size > budget.response_size:
+        violations.append(f'returned {response_size} bytes (budget {budget.response_size})')
+    return violations
+
+
+def apply_query_count_threshold(
+    budget: PerformanceBudget,
+    initial: Optional[int],
+    current: Optional[int],
+) -> PerformanceBudget:
+    """
+    Adjust budget.queries by however much the view changed request.QUERY_COUNT_WARNING_THRESHOLD (see
+    QueryCountMiddleware); if the view set it to a falsy value then the query count isn't checked
+    """
+    if budget.queries is None or current == initial:
+        return budget
+    if not current:
+        return budget._replace(queries=None)
+    return budget._replace(queries=budget.queries + current - (initial or 0))
+
+
+class PerformanceBudgetMiddleware:
+    """
+    Checks each request against the budget for its view:
+
+    - a budget set on the view with the allianceutils.views.decorators.performance_budget decorator
+    - otherwise settings.PERFORMANCE_BUDGETS[view name]
+    - otherwise settings.PERFORMANCE_BUDGET_DEFAULT
+
+    The budget can be changed for a single request by replacing request.performance_budget. Views that raise
+    request.QUERY_COUNT_WARNING_THRESHOLD for QueryCountMiddleware raise the query budget by the same amount.
+
+    Requests that exceed their budget are logged as warnings, or raise PerformanceBudgetExceeded if
+    settings.PERFORMANCE_BUDGET_STRICT is set
+
+    Works as either sync or async middleware (django 3.1+); as with QueryCountMiddleware, async requests count
+    queries through a context variable so that queries run via sync_to_async() are included.
+    """
+    sync_capable = True
+    async_capable = True
+
+    get_response: Callable
+    is_async: bool
+
+    def __init__(self, get_response: Callable):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            if contextvars is None:
+                raise ImproperlyConfigured('Async PerformanceBudgetMiddleware requires contextvars (python 3.7+)')
+            install_context_query_counter()
+            mark_coroutine_function(self)
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        if self.is_async:
+            return self.__acall__(request)
+
+        self.start_request(request)
+        start = time.perf_counter()
+        counter = QueryCounter()
+        with counter.wrap_connections():
+            response = self.get_response(request)
+        self.finish_request(request, response, counter, time.perf_counter() - start)
+        return response
+
+    async def __acall__(self, request: HttpRequest) -> HttpResponse:
+        self.start_request(request)
+        start = time.perf_counter()
+        with context_query_counter(QueryCounter()) as counter:
+            response = await self.get_response(request)
+        self.finish_request(request, response, counter, time.perf_counter() - start)
+        return response
+
+    def start_request(self, request: HttpRequest):
+        request.performance_budget = get_budget_from_settings(None)
+        if not hasattr(request, 'QUERY_COUNT_WARNING_THRESHOLD'):
+            request.QUERY_COUNT_WARNING_THRESHOLD = getattr(
+                settings, 'QUERY_COUNT_WARNING_THRESHOLD', DEFAULT_QUERY_COUNT_WARNING_THRESHOLD
+            )
+        request.performance_budget_query_count_threshold = request.QUERY_COUNT_WARNING_THRESHOLD
+
+    def finish_request(self, request: HttpRequest, response: HttpResponse, counter: QueryCounter, elapsed: float):
+        budget = getattr(request, 'performance_budget', None)
+        if budget is None:
+            return
+        budget = apply_query_count_threshold(
+            budget,
+            getattr(request, 'performance_budget_query_count_threshold', None),
+            getattr(request, 'QUERY_COUNT_WARNING_THRESHOLD', None),
+        )
+        response_size = None if response.streaming else len(response.content)
+        violations = get_budget_violations(budget, counter, elapsed, response_size)
+        if violations:
+            self.budget_exceeded(request, violations)
+
+    def process_view(self, request: HttpRequest, view_func: Callable, view_args: List, view_kwargs: Dict):
+        budget = getattr(view_func, 'performance_budget', None)
+        if budget is None:
+            budget = get_budget_from_settings(request.resolver_match.view_name if request.resolver_match else None)
+        request.performance_budget = budget
+        # QueryCountMiddleware may have (re)set the threshold since start_request(); only changes made by the view count
+        request.performance_budget_query_count_threshold = getattr(request, 'QUERY_COUNT_WARNING_THRESHOLD', None)
+
+    def budget_exceeded(self, request: HttpRequest, violations: List[str]):
+        resolver_match = getattr(request, 'resolver_match', None)
+        view_name = f' ({resolver_match.view_name})' if resolver_match else ''
+        msg = f'performance budget exceeded: request "{request.method} {request.path}"{view_name} ' + ', '.join(violations)
+        if getattr(settings, 'PERFORMANCE_BUDGET_STRICT', False):
+            raise PerformanceBudgetExceeded(msg)
+        logger.warning(msg)
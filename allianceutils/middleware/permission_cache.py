@@ -0,0 +1,16 @@
+from django.http import HttpRequest
+
+from allianceutils.auth.permission_cache import permission_cache
+from allianceutils.middleware.scoped_context import ScopedContextMiddleware
+from allianceutils.util.scoped_context import ScopedContext
+
+
+class PermissionCacheMiddleware(ScopedContextMiddleware):
+    """
+    Memoizes permission checks for the duration of a request
+
+    See allianceutils.auth.permission_cache.permission_cache
+    """
+
+    def get_context(self, request: HttpRequest) -> ScopedContext:
+        return permission_cache()
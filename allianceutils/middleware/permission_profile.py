@@ -0,0 +1,66 @@
+from typing import Callable
+from typing import Dict
+
+from django.conf import settings
+from django.http import HttpRequest
+from django.http import HttpResponse
+from django.utils.module_loading import import_string
+
+from allianceutils.auth.permission_profile import permission_profile
+from allianceutils.auth.permission_profile import PermissionStats
+from allianceutils.middleware.scoped_context import ScopedContextMiddleware
+from allianceutils.util.scoped_context import ScopedContext
+
+PERMISSION_PROFILE_HEADER = 'X-Permission-Profile'
+
+
+def format_permission_profile(stats: Dict[str, PermissionStats], limit: int) -> str:
+    """
+    Format permission stats for a response header, slowest permissions first
+    """
+    slowest = sorted(stats.items(), key=lambda item: item[1].time, reverse=True)[:limit]
+    return ', '.join(
+        f'{perm};calls={perm_stats.calls};global={perm_stats.global_calls};object={perm_stats.object_calls};'
+        f'cached={perm_stats.cached_calls};dur={perm_stats.time * 1000:.3f}'
+        for perm, perm_stats in slowest
+    )
+
+
+class PermissionProfileMiddleware(ScopedContextMiddleware):
+    """
+    Records the permission checks made during each request (see allianceutils.auth.permission_profile)
+
+    - If settings.DEBUG is set then a summary is added to the response in the X-Permission-Profile header
+    - If settings.PERMISSION_PROFILE_CALLBACK is set (a callable or dotted path to one) then it is called with
+      (request, response, stats) after every request that checked permissions
+
+    Works as either sync or async middleware (django 3.1+)
+    """
+
+    # maximum number of permissions to include in the response header
+    header_limit = 20
+
+    def get_callback(self) -> Callable:
+        callback = getattr(settings, 'PERMISSION_PROFILE_CALLBACK', None)
+        if isinstance(callback, str):
+            callback = import_string(callback)
+        return callback
+
+    def get_context(self, request: HttpRequest) -> ScopedContext:
+        return permission_profile()
+
+    def finish_request(
+        self,
+        request: HttpRequest,
+        response: HttpResponse,
+        stats: Dict[str, PermissionStats],
+    ) -> HttpResponse:
+        if stats:
+            if settings.DEBUG:
+                response[PERMISSION_PROFILE_HEADER] = format_permission_profile(stats, self.header_limit)
+
+            callback = self.get_callback()
+            if callback is not None:
+                callback(request, response, stats)
+
+        return response
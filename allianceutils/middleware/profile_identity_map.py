@@ -0,0 +1,17 @@
+from django.http import HttpRequest
+
+from allianceutils.middleware.scoped_context import ScopedContextMiddleware
+from allianceutils.util.scoped_context import ScopedContext
+
+
+class ProfileIdentityMapMiddleware(ScopedContextMiddleware):
+    """
+    Shares resolved user profiles between all records with the same user pk for the duration of a request
+
+    See allianceutils.auth.models.profile_identity_map
+    """
+
+    def get_context(self, request: HttpRequest) -> ScopedContext:
+        # imported here so that allianceutils.middleware can still be used without django.contrib.auth installed
+        from allianceutils.auth.models import profile_identity_map
+        return profile_identity_map()
@@ -30,55 +30,458 @@ Instead we dynamically create a new class for the connection to override cursor(
 
 NOTE: We could have used django signals but since this is going to be called on every single SQL query we want to
 avoid the associated overhead
+
+Every alias in django.db.connections is wrapped, not just the default connection. connections[alias] only creates
+the (thread local) connection wrapper object; the underlying database connection is opened lazily on first use and
+execute wrappers are kept on the wrapper object, so connections that are first opened part way through a request
+are counted too.
 """
+import asyncio
+from collections import deque
+from contextlib import contextmanager
+from contextlib import ExitStack
+import functools
+import itertools
 import logging
+import math
+import os
+import re
+import sys
+import sysconfig
+import threading
+import time
 from typing import Callable
+from typing import Deque
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
 import warnings
 
+import django
 from django.conf import settings
-from django.db import connection
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.db.backends.signals import connection_created
 from django.http import HttpRequest
 from django.http import HttpResponse
 
+from allianceutils.util.async_utils import mark_coroutine_function
+
+try:
+    import contextvars
+except ImportError:
+    # python 3.6
+    contextvars = None
+
 DEFAULT_QUERY_COUNT_WARNING_THRESHOLD = 50
+DEFAULT_MAX_FINGERPRINTS = 200
+DEFAULT_QUERY_COUNT_SAMPLE_BUFFER_SIZE = 100
+UNRESOLVED_VIEW_NAME = '<unresolved>'
 
 logger = logging.getLogger('django.db')
 
+# QueryCounters for the current request when QueryCountMiddleware (or PerformanceBudgetMiddleware) is used as async
+# middleware; outermost first
+_context_query_counters = contextvars.ContextVar('query_counters') if contextvars is not None else None
+
+_sql_string_re = re.compile(r"'(?:[^'\\]|''|\\.)*'")
+_sql_number_re = re.compile(r'(?<![\w."`])-?\d+(?:\.\d+)?(?:e[+-]?\d+)?\b', re.IGNORECASE)
+_sql_placeholder_re = re.compile(r'%s|%\(\w+\)s|\?')
+_sql_list_re = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_sql_whitespace_re = re.compile(r'\s+')
+
+# frames from these directories are skipped when looking for the application code that ran a query
+_library_paths = tuple(
+    os.path.join(os.path.realpath(path), '')
+    for path in {
+        os.path.dirname(django.__file__),
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        sysconfig.get_paths()['stdlib'],
+        sysconfig.get_paths()['purelib'],
+        sysconfig.get_paths()['platlib'],
+    }
+)
+
+
+def normalize_sql(sql: str) -> str:
+    """
+    Reduce SQL to a fingerprint that is the same for queries that differ only in their literals or parameters
+
+    String & number literals and parameter placeholders become ?, and lists of these (eg IN (1, 2, 3)) become (...)
+    """
+    sql = _sql_string_re.sub('?', sql)
+    sql = _sql_number_re.sub('?', sql)
+    sql = _sql_placeholder_re.sub('?', sql)
+    sql = _sql_list_re.sub('(...)', sql)
+    return _sql_whitespace_re.sub(' ', sql).strip()
+
+
+def get_application_frame() -> Optional[str]:
+    """
+    Describe the innermost stack frame that isn't in django, allianceutils or an installed library
+
+    :return: "filename:lineno in function", or None if there is no such frame
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = os.path.realpath(frame.f_code.co_filename)
+        if not filename.startswith(_library_paths) and not filename.startswith('<'):
+            return f'{frame.f_code.co_filename}:{frame.f_lineno} in {frame.f_code.co_name}'
+        frame = frame.f_back
+    return None
+
+
+class QueryFingerprint:
+    """
+    Queries recorded for a single normalize_sql() fingerprint
+    """
+    sql: str
+    count: int
+    # application code that ran this query the first time it was repeated
+    frame: Optional[str]
+
+    def __init__(self, sql: str):
+        self.sql = sql
+        self.count = 0
+        self.frame = None
+
+    def __repr__(self):
+        return f'<QueryFingerprint count={self.count} sql={self.sql!r}>'
+
 
 class QueryCounter:
+    """
+    execute_wrapper() callable that counts & times queries, both in total and per database alias
+
+    Only the SQL of the slowest query is kept
+
+    If fingerprint is True then queries are also counted per normalize_sql() fingerprint. At most max_fingerprints
+    distinct fingerprints are kept; queries with any further fingerprints are only counted in fingerprints_dropped.
+    """
+    # number of execute() + executemany() calls
     count: int
+    counts: Dict[str, int]
+    # number of executemany() calls (these are also included in count)
+    many_count: int
+    # seconds spent executing queries
+    time: float
+    slowest_time: float
+    slowest_sql: Optional[str]
+    slowest_alias: Optional[str]
+    fingerprints: Optional[Dict[str, QueryFingerprint]]
+    fingerprints_dropped: int
+    max_fingerprints: int
 
-    def __init__(self):
+    def __init__(self, fingerprint: bool = False, max_fingerprints: int = DEFAULT_MAX_FINGERPRINTS):
         self.count = 0
+        self.counts = {}
+        self.many_count = 0
+        self.time = 0.0
+        self.slowest_time = 0.0
+        self.slowest_sql = None
+        self.slowest_alias = None
+        self.fingerprints = {} if fingerprint else None
+        self.fingerprints_dropped = 0
+        self.max_fingerprints = max_fingerprints
 
     def __call__(self, execute, sql, params, many, context):
+        alias = context['connection'].alias
         self.count += 1
-        return execute(sql, params, many, context)
+        self.counts[alias] = self.counts.get(alias, 0) + 1
+        if many:
+            self.many_count += 1
+        if self.fingerprints is not None:
+            self.record_fingerprint(sql)
+
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.time += elapsed
+            if elapsed > self.slowest_time or self.slowest_sql is None:
+                self.slowest_time = elapsed
+                self.slowest_sql = sql
+                self.slowest_alias = alias
+
+    def record_fingerprint(self, sql: str):
+        key = normalize_sql(sql)
+        try:
+            fingerprint = self.fingerprints[key]
+        except KeyError:
+            if len(self.fingerprints) >= self.max_fingerprints:
+                self.fingerprints_dropped += 1
+                return
+            fingerprint = self.fingerprints[key] = QueryFingerprint(key)
+        fingerprint.count += 1
+        if fingerprint.count == 2:
+            fingerprint.frame = get_application_frame()
+
+    def get_repeated_fingerprints(self, threshold: int) -> List[QueryFingerprint]:
+        """
+        Fingerprints that were run more than threshold times, most repeated first
+        """
+        repeated = [fp for fp in (self.fingerprints or {}).values() if fp.count > threshold]
+        return sorted(repeated, key=lambda fp: -fp.count)
+
+    def wrap_connections(self) -> ExitStack:
+        """
+        Install this counter on every database connection; the returned ExitStack removes it again on exit
+        """
+        stack = ExitStack()
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(self))
+        return stack
+
+
+def _context_query_counter_wrapper(execute, sql, params, many, context):
+    for counter in _context_query_counters.get(()):
+        execute = functools.partial(counter, execute)
+    return execute(sql, params, many, context)
+
+
+def _install_context_query_counter_wrapper(connection: BaseDatabaseWrapper, **kwargs):
+    if _context_query_counter_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_context_query_counter_wrapper)
+
+
+def install_context_query_counter():
+    """
+    Permanently install an execute wrapper on every database connection (in every thread) that passes queries to the
+    QueryCounter in the current context (if any)
+
+    Connection wrapper objects are thread local so this is done for the current thread's connections immediately and
+    for other threads' connections as they connect
+    """
+    connection_created.connect(_install_context_query_counter_wrapper, dispatch_uid='allianceutils.query_count')
+    for alias in connections:
+        _install_context_query_counter_wrapper(connections[alias])
+
+
+@contextmanager
+def context_query_counter(counter: QueryCounter) -> Iterator[QueryCounter]:
+    """
+    Pass queries run in the current context (including via sync_to_async()) to counter; requires
+    install_context_query_counter()
+    """
+    token = _context_query_counters.set(_context_query_counters.get(()) + (counter,))
+    try:
+        yield counter
+    finally:
+        _context_query_counters.reset(token)
+
+
+class QueryProfileSample(NamedTuple):
+    count: int
+    time: float
+
+
+class QueryProfileStats(NamedTuple):
+    """
+    Summary of the samples recorded for a single view; times are in seconds
+    """
+    samples: int
+    count_p50: int
+    count_p95: int
+    count_max: int
+    time_p50: float
+    time_p95: float
+    time_max: float
+
+
+# view name => most recent samples for that view
+_query_profile_samples: Dict[str, Deque[QueryProfileSample]] = {}
+_query_profile_samples_lock = threading.Lock()
+
+
+def record_query_profile_sample(view_name: str, counter: QueryCounter):
+    """
+    Add a request's query count & time to the per-view ring buffer
+
+    Each view keeps the most recent settings.QUERY_COUNT_SAMPLE_BUFFER_SIZE samples
+    """
+    sample = QueryProfileSample(counter.count, counter.time)
+    with _query_profile_samples_lock:
+        try:
+            samples = _query_profile_samples[view_name]
+        except KeyError:
+            buffer_size = getattr(settings, 'QUERY_COUNT_SAMPLE_BUFFER_SIZE', DEFAULT_QUERY_COUNT_SAMPLE_BUFFER_SIZE)
+            samples = _query_profile_samples[view_name] = deque(maxlen=buffer_size)
+        samples.append(sample)
+
+
+def clear_query_profile_samples():
+    with _query_profile_samples_lock:
+        _query_profile_samples.clear()
+
+
+def _percentile(ordered: Sequence, percent: int):
+    # nearest-rank percentile
+    return ordered[max(0, math.ceil(len(ordered) * percent / 100) - 1)]
+
+
+def get_query_profile_stats() -> Dict[str, QueryProfileStats]:
+    """
+    Summarise the samples recorded by QueryCountMiddleware in this process
+
+    :return: view name => stats, sorted by view name
+    """
+    with _query_profile_samples_lock:
+        samples_by_view = {view_name: list(samples) for view_name, samples in _query_profile_samples.items()}
+
+    stats = {}
+    for view_name, samples in sorted(samples_by_view.items()):
+        counts = sorted(sample.count for sample in samples)
+        times = sorted(sample.time for sample in samples)
+        stats[view_name] = QueryProfileStats(
+            samples=len(samples),
+            count_p50=_percentile(counts, 50),
+            count_p95=_percentile(counts, 95),
+            count_max=counts[-1],
+            time_p50=_percentile(times, 50),
+            time_p95=_percentile(times, 95),
+            time_max=times[-1],
+        )
+    return stats
 
 
 class QueryCountMiddleware:
+    """
+    Can be used as either sync or async middleware (django 3.1+)
+
+    When used as async middleware the request's QueryCounter is carried in a context variable so that queries run in
+    other threads via sync_to_async() are attributed to the request that made them.
+
+    If settings.QUERY_COUNT_SAMPLE_RATE is set then only the sampled requests are counted; the rest skip all query
+    counting (and so all warnings) to keep the overhead down.
+    """
+    sync_capable = True
+    async_capable = True
+
     get_response: Callable
+    # maximum number of repeated queries to include in a duplicate query warning
+    duplicate_log_limit: int = 5
+    # number of requests seen; used to pick 1 in settings.QUERY_COUNT_SAMPLE_RATE requests to sample
+    request_counter: Callable[[], int]
+    is_async: bool
 
     def __init__(self, get_response: Callable):
         self.get_response = get_response
+        self.request_counter = itertools.count().__next__
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            if contextvars is None:
+                raise ImproperlyConfigured('Async QueryCountMiddleware requires contextvars (python 3.7+)')
+            install_context_query_counter()
+            mark_coroutine_function(self)
 
     def __call__(self, request: HttpRequest) -> HttpResponse:
+        if self.is_async:
+            return self.__acall__(request)
+
+        if self.is_duplicate(request):
+            return self.get_response(request)
+
+        counter = self.start_request(request)
+        if counter is None:
+            return self.get_response(request)
+        with counter.wrap_connections():
+            response = self.get_response(request)
+        self.finish_request(request, response, counter)
+        return response
+
+    async def __acall__(self, request: HttpRequest) -> HttpResponse:
+        if self.is_duplicate(request):
+            return await self.get_response(request)
+
+        counter = self.start_request(request)
+        if counter is None:
+            return await self.get_response(request)
+        with context_query_counter(counter):
+            response = await self.get_response(request)
+        self.finish_request(request, response, counter)
+        return response
+
+    def is_duplicate(self, request: HttpRequest) -> bool:
         # check for QueryCountMiddleware being included twice
         if getattr(request, 'querycountmiddleware', None) not in (None, self):
             msg = "QueryCountMiddleware appears to be already initialised (did you include QueryCountMiddleware multiple times?)"
             warnings.warn(msg, RuntimeWarning)
-            return self.get_response(request)
+            return True
+        return False
 
+    def start_request(self, request: HttpRequest) -> Optional[QueryCounter]:
+        """
+        :return: the QueryCounter for this request, or None if queries are not being counted for it
+        """
         request.querycountmiddleware = self
         request.querycountmiddleware_query_count = 0
         request.QUERY_COUNT_WARNING_THRESHOLD = getattr(settings, 'QUERY_COUNT_WARNING_THRESHOLD', DEFAULT_QUERY_COUNT_WARNING_THRESHOLD)
+        request.QUERY_COUNT_ALIAS_WARNING_THRESHOLDS = dict(getattr(settings, 'QUERY_COUNT_ALIAS_WARNING_THRESHOLDS', {}))
+        request.QUERY_COUNT_DUPLICATE_THRESHOLD = getattr(settings, 'QUERY_COUNT_DUPLICATE_THRESHOLD', None)
 
-        counter = QueryCounter()
-        with connection.execute_wrapper(counter):
-            response = self.get_response(request)
+        sample_rate = getattr(settings, 'QUERY_COUNT_SAMPLE_RATE', None)
+        request.querycountmiddleware_sampled = bool(sample_rate) and self.request_counter() % sample_rate == 0
+        if sample_rate and not request.querycountmiddleware_sampled:
+            return None
+
+        return QueryCounter(fingerprint=bool(request.QUERY_COUNT_DUPLICATE_THRESHOLD))
+
+    def finish_request(self, request: HttpRequest, response: HttpResponse, counter: QueryCounter):
         query_count = counter.count
+        request.querycountmiddleware_query_count = query_count
+
+        description = f'request "{request.method} {request.path}" ran {query_count} queries'
+        if len(counter.counts) > 1:
+            description += ' (' + ', '.join(f'{alias}: {count}' for alias, count in sorted(counter.counts.items())) + ')'
 
         if getattr(request, 'QUERY_COUNT_WARNING_THRESHOLD', 0) and query_count >= request.QUERY_COUNT_WARNING_THRESHOLD:
-            logger.warning(f'excessive query count: request "{request.method} {request.path}" ran {query_count} queries')
+            logger.warning(f'excessive query count: {description}')
 
-        return response
+        alias_thresholds = getattr(request, 'QUERY_COUNT_ALIAS_WARNING_THRESHOLDS', None) or {}
+        for alias, alias_count in sorted(counter.counts.items()):
+            threshold = alias_thresholds.get(alias)
+            if threshold and alias_count >= threshold:
+                logger.warning(f'excessive query count on database "{alias}": {description}')
+
+        duplicate_threshold = getattr(request, 'QUERY_COUNT_DUPLICATE_THRESHOLD', None)
+        if duplicate_threshold and counter.fingerprints is not None:
+            self.warn_repeated_queries(request, counter, duplicate_threshold)
+
+        if getattr(settings, 'QUERY_COUNT_SERVER_TIMING', False):
+            self.add_server_timing(response, counter)
+
+        if getattr(request, 'querycountmiddleware_sampled', False):
+            resolver_match = getattr(request, 'resolver_match', None)
+            record_query_profile_sample(resolver_match.view_name if resolver_match else UNRESOLVED_VIEW_NAME, counter)
+
+    def warn_repeated_queries(self, request: HttpRequest, counter: QueryCounter, threshold: int):
+        """
+        Log the most repeated queries if any query was run more than threshold times (usually an N+1 pattern)
+        """
+        repeated = counter.get_repeated_fingerprints(threshold)
+        if not repeated:
+            return
+        lines = [
+            f'repeated queries: request "{request.method} {request.path}" ran {len(repeated)} '
+            f'distinct queries more than {threshold} times'
+        ]
+        for fingerprint in repeated[:self.duplicate_log_limit]:
+            lines.append(f'  {fingerprint.count}x {fingerprint.sql}')
+            if fingerprint.frame:
+                lines.append(f'    at {fingerprint.frame}')
+        logger.warning('\n'.join(lines))
+
+    @staticmethod
+    def add_server_timing(response: HttpResponse, counter: QueryCounter):
+        """
+        Add a Server-Timing metric for database time to the response, preserving any existing metrics
+        """
+        metric = f'db;dur={counter.time * 1000:.3f};desc="{counter.count} queries"'
+        if response.has_header('Server-Timing'):
+            metric = f'{response["Server-Timing"]}, {metric}'
+        response['Server-Timing'] = metric
@@ -0,0 +1,51 @@
+import asyncio
+from typing import Any
+from typing import Callable
+
+from django.http import HttpRequest
+from django.http import HttpResponse
+
+from allianceutils.util.async_utils import mark_coroutine_function
+from allianceutils.util.scoped_context import ScopedContext
+
+
+class ScopedContextMiddleware:
+    """
+    Base class for middleware that runs each request inside a ScopedContext (see allianceutils.util.scoped_context)
+
+    Can be used as either sync or async middleware (django 3.1+); subclasses implement get_context() and optionally
+    finish_request()
+    """
+    sync_capable = True
+    async_capable = True
+
+    get_response: Callable
+    is_async: bool
+
+    def __init__(self, get_response: Callable):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            mark_coroutine_function(self)
+
+    def get_context(self, request: HttpRequest) -> ScopedContext:
+        raise NotImplementedError
+
+    def finish_request(self, request: HttpRequest, response: HttpResponse, value: Any) -> HttpResponse:
+        """
+        Called after the context has exited with the value the context had
+        """
+        return response
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        if self.is_async:
+            return self.__acall__(request)
+
+        with self.get_context(request) as value:
+            response = self.get_response(request)
+        return self.finish_request(request, response, value)
+
+    async def __acall__(self, request: HttpRequest) -> HttpResponse:
+        with self.get_context(request) as value:
+            response = await self.get_response(request)
+        return self.finish_request(request, response, value)
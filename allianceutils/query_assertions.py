@@ -0,0 +1,150 @@
+from contextlib import ContextDecorator
+from contextlib import ExitStack
+import difflib
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from allianceutils.middleware.query_count import QueryCounter
+
+# tests need every fingerprint to compare profiles so this is much higher than the per-request default
+MAX_FINGERPRINTS = 10000
+
+
+def get_query_profile(counter: QueryCounter) -> Dict[str, int]:
+    """
+    :return: normalized SQL => number of times run
+    """
+    return {fingerprint.sql: fingerprint.count for fingerprint in counter.fingerprints.values()}
+
+
+def format_query_profile(profile: Dict[str, int]) -> List[str]:
+    return [f'{count}x {sql}' for sql, count in sorted(profile.items())]
+
+
+def check_max_queries(counter: QueryCounter, max_queries: int, alias: Optional[str] = None) -> Optional[str]:
+    count = counter.count if alias is None else counter.counts.get(alias, 0)
+    if count <= max_queries:
+        return None
+    on_alias = '' if alias is None else f' on database "{alias}"'
+    return f'{count} queries run{on_alias}, expected at most {max_queries}:\n' + '\n'.join(
+        format_query_profile(get_query_profile(counter))
+    )
+
+
+def check_duplicate_queries(counter: QueryCounter, threshold: int = 1) -> Optional[str]:
+    repeated = counter.get_repeated_fingerprints(threshold)
+    if not repeated:
+        return None
+    lines = [f'{len(repeated)} queries run more than {threshold} times:']
+    for fingerprint in repeated:
+        lines.append(f'{fingerprint.count}x {fingerprint.sql}')
+        if fingerprint.frame:
+            lines.append(f'    at {fingerprint.frame}')
+    return '\n'.join(lines)
+
+
+def check_query_profile(counter: QueryCounter, expected: Dict[str, int]) -> Optional[str]:
+    profile = get_query_profile(counter)
+    if profile == expected and not counter.fingerprints_dropped:
+        return None
+    diff = difflib.unified_diff(
+        format_query_profile(expected),
+        format_query_profile(profile),
+        fromfile='expected',
+        tofile='actual',
+        lineterm='',
+    )
+    return 'Query profile changed:\n' + '\n'.join(diff)
+
+
+class query_profile(ContextDecorator):
+    """
+    Context manager / decorator that captures the queries run on every database (see QueryCounter) and then asserts:
+
+    - max_queries: at most this many queries were run in total
+    - alias_max_queries: {alias: n} at most n queries were run on each alias
+    - duplicate_threshold: no normalized query was run more than this many times
+    - expected: the queries run exactly match this profile ({normalized SQL: count}, see get_query_profile())
+
+    An AssertionError describing every failed check is raised on exit (unless the block raised an exception)
+
+    Each use has its own counter so the same instance can be nested or (as a decorator) used recursively or from
+    several threads at once
+    """
+    max_queries: Optional[int]
+    alias_max_queries: Dict[str, int]
+    duplicate_threshold: Optional[int]
+    expected: Optional[Dict[str, int]]
+    # one entry per nested __enter__()
+    _runs: List[Tuple[QueryCounter, ExitStack]]
+
+    def __init__(
+        self,
+        max_queries: Optional[int] = None,
+        alias_max_queries: Optional[Dict[str, int]] = None,
+        duplicate_threshold: Optional[int] = None,
+        expected: Optional[Dict[str, int]] = None,
+    ):
+        self.max_queries = max_queries
+        self.alias_max_queries = alias_max_queries or {}
+        self.duplicate_threshold = duplicate_threshold
+        self.expected = expected
+        self._runs = []
+
+    def _recreate_cm(self) -> 'query_profile':
+        # called by ContextDecorator for each call of a decorated function
+        return type(self)(
+            max_queries=self.max_queries,
+            alias_max_queries=self.alias_max_queries,
+            duplicate_threshold=self.duplicate_threshold,
+            expected=self.expected,
+        )
+
+    def __enter__(self) -> QueryCounter:
+        counter = QueryCounter(fingerprint=True, max_fingerprints=MAX_FINGERPRINTS)
+        wrappers = counter.wrap_connections()
+        wrappers.__enter__()
+        self._runs.append((counter, wrappers))
+        return counter
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        counter, wrappers = self._runs.pop()
+        wrappers.__exit__(exc_type, exc_val, exc_tb)
+        if exc_type is not None:
+            return
+
+        failures = []
+        if self.max_queries is not None:
+            failures.append(check_max_queries(counter, self.max_queries))
+        for alias, max_queries in sorted(self.alias_max_queries.items()):
+            failures.append(check_max_queries(counter, max_queries, alias))
+        if self.duplicate_threshold is not None:
+            failures.append(check_duplicate_queries(counter, self.duplicate_threshold))
+        if self.expected is not None:
+            failures.append(check_query_profile(counter, self.expected))
+
+        failures = [failure for failure in failures if failure is not None]
+        if failures:
+            raise AssertionError('\n\n'.join(failures))
+
+
+class QueryProfileTestCaseMixin:
+    """
+    Query assertions for SimpleTestCase / TestCase; each returns a query_profile() context manager
+
+        with self.assertMaxQueries(5):
+            self.client.get('/orders/')
+    """
+
+    def assertMaxQueries(self, max_queries: int, using: Optional[str] = None) -> query_profile:
+        if using is None:
+            return query_profile(max_queries=max_queries)
+        return query_profile(alias_max_queries={using: max_queries})
+
+    def assertNoDuplicateQueries(self, threshold: int = 1) -> query_profile:
+        return query_profile(duplicate_threshold=threshold)
+
+    def assertQueryProfile(self, expected: Dict[str, int]) -> query_profile:
+        return query_profile(expected=expected)
@@ -1,4 +1,64 @@
+import time
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+from django.contrib.auth import get_backends
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth.models import PermissionsMixin
+from django.core.exceptions import PermissionDenied
+from django.db.models import Model
+from django.db.models import Q
 import rules
+from rules.permissions import ObjectPermissionBackend
+
+from allianceutils.auth.permission_cache import cached_has_perm
+from allianceutils.auth.permission_cache import cached_has_perms
+from allianceutils.auth.permission_cache import get_cached_decision
+from allianceutils.auth.permission_cache import record_decision
+from allianceutils.auth.permission_profile import record_permission_check
+
+# (predicate kind, permissions) -> predicate; see _perm_predicate()
+_interned_predicates: Dict[Tuple[str, Tuple[str, ...]], rules.Predicate] = {}
+
+
+def _perm_predicate(kind: str, name: str, perms: Tuple[str, ...], obj, test: Callable[[Model], bool]) -> rules.Predicate:
+    """
+    Creates the predicate for has_perm() / has_perms() / has_any_perms()
+
+    Predicates without an obj are interned so that identical calls share the same predicate (predicates bound to
+    an obj are not as the obj would then never be garbage collected).
+
+    Results are cached in the rules invocation context so that a predicate used more than once in a combined rule
+    is only evaluated once per rule check.
+    """
+    key = (kind, perms)
+    if obj is None:
+        try:
+            return _interned_predicates[key]
+        except KeyError:
+            pass
+
+    @rules.predicates.predicate(name, bind=True)
+    def check(self, user):
+        context = self.context
+        if context is None:
+            # called directly rather than via test()
+            return test(user)
+        try:
+            return context[self]
+        except KeyError:
+            pass
+        result = context[self] = test(user)
+        return result
+
+    if obj is None:
+        check = _interned_predicates.setdefault(key, check)
+    return check
 
 
 def has_perm(perm, obj=None):
@@ -8,13 +68,13 @@ def has_perm(perm, obj=None):
     :param perm: permission to check
     :return: django_rules predicate
     """
-    name = 'has_perm:%s' % perm
-
-    @rules.predicates.predicate(name)
-    def check(user):
-        return user.has_perm(perm, obj)
-
-    return check
+    return _perm_predicate(
+        'has_perm',
+        'has_perm:%s' % perm,
+        (perm,),
+        obj,
+        lambda user: cached_has_perm(user, perm, obj),
+    )
 
 
 def has_perms(perms, obj=None):
@@ -24,13 +84,14 @@ def has_perms(perms, obj=None):
     :param perms: permissions to check
     :return: django_rules predicate
     """
-    name = 'has_perms:%s' % ','.join(perms)
-
-    @rules.predicates.predicate(name)
-    def check(user):
-        return user.has_perms(perms, obj)
-
-    return check
+    perms = tuple(perms)
+    return _perm_predicate(
+        'has_perms',
+        'has_perms:%s' % ','.join(perms),
+        perms,
+        obj,
+        lambda user: cached_has_perms(user, perms, obj),
+    )
 
 
 def has_any_perms(perms, obj=None):
@@ -40,10 +101,179 @@ def has_any_perms(perms, obj=None):
     :param *perms: permissions to check
     :return: django_rules predicate
     """
-    name = 'has_any_perms:%s' % ','.join(perms)
+    perms = tuple(perms)
+    return _perm_predicate(
+        'has_any_perms',
+        'has_any_perms:%s' % ','.join(perms),
+        perms,
+        obj,
+        lambda user: any(cached_has_perm(user, perm, obj) for perm in perms),
+    )
 
-    @rules.predicates.predicate(name)
-    def check(user):
-        return any(user.has_perm(perm, obj) for perm in perms)
 
-    return check
+def filterable(q_func: Callable[[Model], Q]) -> Callable[[rules.Predicate], rules.Predicate]:
+    """
+    Decorator that declares the Q expression equivalent to an object-level predicate so that
+    querysets can be filtered in the database instead of checking each object in python
+    (see allianceutils.api.permissions.ObjectPermissionFilterBackend)
+
+    Note that combining predicates with &, |, ~ creates a new predicate; the combined predicate needs its own
+    filterable() declaration
+    :param q_func: function that takes a user and returns a Q object that matches only the objects the predicate
+        would return True for
+    :return: decorator that attaches q_func to a predicate
+    """
+    def decorator(predicate):
+        predicate.filter_q = q_func
+        return predicate
+
+    return decorator
+
+
+def get_permission_q(perm: str, user: Model) -> Optional[Q]:
+    """
+    Get the Q expression that filters objects down to those that user has perm for
+    :param perm: permission to check
+    :param user: user to check
+    :return: Q object, or None if there is no rule for perm or its predicate has no filterable() declaration
+    """
+    if not rules.permissions.perm_exists(perm):
+        return None
+    q_func = getattr(rules.permissions.permissions[perm], 'filter_q', None)
+    return None if q_func is None else q_func(user)
+
+
+def batchable(batch_func: Callable[[Model, Sequence[Model]], Iterable[bool]]) -> Callable[[rules.Predicate], rules.Predicate]:
+    """
+    Decorator that declares a function that evaluates an object-level predicate for many objects at once so that
+    supporting data (eg memberships) can be fetched once for the whole batch (see has_perm_batch())
+
+    Note that combining predicates with &, |, ~ creates a new predicate; the combined predicate needs its own
+    batchable() declaration
+    :param batch_func: function that takes a user and a sequence of objects and returns what the predicate would
+        return for each object, in the same order
+    :return: decorator that attaches batch_func to a predicate
+    """
+    def decorator(predicate):
+        predicate.batch_test = batch_func
+        return predicate
+
+    return decorator
+
+
+def _test_rule_batch(user: Model, perm: str, objs: Sequence[Model]) -> Optional[List[bool]]:
+    """
+    Evaluate the rule for perm against each of objs, or return None if it has no batchable() declaration
+    """
+    if not rules.permissions.perm_exists(perm):
+        return None
+    batch_func = getattr(rules.permissions.permissions[perm], 'batch_test', None)
+    if batch_func is None:
+        return None
+    results = [bool(result) for result in batch_func(user, objs)]
+    assert len(results) == len(objs), 'batchable() function for %s returned the wrong number of results' % perm
+    return results
+
+
+def _uses_default_has_perm(user: Model) -> bool:
+    """
+    Whether user.has_perm() is django's implementation, which checks each authentication backend in turn
+    """
+    return getattr(type(user), 'has_perm', None) in (PermissionsMixin.has_perm, AnonymousUser.has_perm)
+
+
+def _backends_have_perm(user: Model, perm: str, obj: Model, rule_result: bool) -> bool:
+    """
+    user.has_perm(perm, obj) for a user with django's has_perm() but using rule_result instead of asking django-rules
+    """
+    # mirrors django.contrib.auth.models.PermissionsMixin.has_perm() & _user_has_perm()
+    if user.is_active and user.is_superuser:
+        return True
+    for backend in get_backends():
+        if isinstance(backend, ObjectPermissionBackend):
+            if rule_result:
+                return True
+            continue
+        if not hasattr(backend, 'has_perm'):
+            continue
+        try:
+            if backend.has_perm(user, perm, obj):
+                return True
+        except PermissionDenied:
+            return False
+    return False
+
+
+def has_perm_batch(user: Model, perm: str, objs: Iterable[Model]) -> List[bool]:
+    """
+    Check a permission against many objects at once
+
+    Equivalent to [user.has_perm(perm, obj) for obj in objs] but if the permission's rule has a batchable()
+    declaration then it is evaluated once for all objects. Other authentication backends are still checked
+    for each object. Permissions without a batchable() rule, and users whose model overrides has_perm(), are
+    checked with cached_has_perm() one object at a time.
+
+    Results are recorded in (and read from) the active permission_cache() context, if any, and checks are recorded
+    by the active permission_profile() context, if any.
+    :param user: user to check
+    :param perm: permission to check
+    :param objs: objects to check
+    :return: list of results, in the same order as objs
+    """
+    objs = list(objs)
+    rule_results = None
+    # can only bypass user.has_perm() if we know what it does
+    if _uses_default_has_perm(user) and any(isinstance(b, ObjectPermissionBackend) for b in get_backends()):
+        unknown = [i for i, obj in enumerate(objs) if get_cached_decision(user, perm, obj) is None]
+        if unknown:
+            start = time.perf_counter()
+            rule_results = _test_rule_batch(user, perm, [objs[i] for i in unknown])
+            batch_time = time.perf_counter() - start
+
+    if rule_results is None:
+        return [cached_has_perm(user, perm, obj) for obj in objs]
+
+    results = [None] * len(objs)
+    for i, rule_result in zip(unknown, rule_results):
+        start = time.perf_counter()
+        results[i] = _backends_have_perm(user, perm, objs[i], rule_result)
+        record_decision(user, perm, objs[i], results[i])
+        # the batch evaluation time is shared equally between the objects it was evaluated for
+        record_permission_check(perm, True, time.perf_counter() - start + batch_time / len(unknown))
+    for i, result in enumerate(results):
+        if result is None:
+            # already decided; this also records the cache hit
+            results[i] = cached_has_perm(user, perm, objs[i])
+    return results
+
+
+def has_perms_batch(user: Model, perms: Iterable[str], objs: Iterable[Model]) -> List[bool]:
+    """
+    Check that the user has all of a set of permissions for each of many objects (see has_perm_batch())
+    :return: list of results, in the same order as objs
+    """
+    objs = list(objs)
+    results = [True] * len(objs)
+    for perm in perms:
+        remaining = [i for i, result in enumerate(results) if result]
+        if not remaining:
+            break
+        for i, result in zip(remaining, has_perm_batch(user, perm, [objs[i] for i in remaining])):
+            results[i] = result
+    return results
+
+
+def has_any_perms_batch(user: Model, perms: Iterable[str], objs: Iterable[Model]) -> List[bool]:
+    """
+    Check that the user has at least one of a set of permissions for each of many objects (see has_perm_batch())
+    :return: list of results, in the same order as objs
+    """
+    objs = list(objs)
+    results = [False] * len(objs)
+    for perm in perms:
+        remaining = [i for i, result in enumerate(results) if not result]
+        if not remaining:
+            break
+        for i, result in zip(remaining, has_perm_batch(user, perm, [objs[i] for i in remaining])):
+            results[i] = result
+    return results
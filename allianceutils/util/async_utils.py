@@ -0,0 +1,19 @@
+import asyncio
+
+try:
+    from asgiref.sync import markcoroutinefunction
+except ImportError:
+    markcoroutinefunction = None
+
+
+def mark_coroutine_function(obj: object):
+    """
+    Mark an object with an async __call__ so that asyncio.iscoroutinefunction() (and hence django) treats it as a
+    coroutine function
+
+    This is how django's MiddlewareMixin marks middleware instances as async
+    """
+    if markcoroutinefunction is not None:
+        markcoroutinefunction(obj)
+    else:
+        obj._is_coroutine = asyncio.coroutines._is_coroutine
@@ -0,0 +1,80 @@
+import threading
+from typing import Any
+from typing import List
+from typing import Optional
+
+try:
+    import contextvars
+except ImportError:
+    # python 3.6
+    contextvars = None
+
+
+class ThreadLocalVar(threading.local):
+    """
+    Minimal stand-in for contextvars.ContextVar on python 3.6; values are per thread rather than per context
+    """
+    def get(self, default=None):
+        return getattr(self, 'value', default)
+
+    def set(self, value):
+        token = self.get()
+        self.value = value
+        return token
+
+    def reset(self, token):
+        self.value = token
+
+
+def make_context_var(name: str):
+    """
+    Create a context variable with a default of None, or a ThreadLocalVar if contextvars is not available
+    """
+    if contextvars is None:
+        return ThreadLocalVar()
+    return contextvars.ContextVar(name, default=None)
+
+
+class ScopedContext:
+    """
+    Base class for context managers that create a value that lasts until the outermost context is exited
+
+    Nested contexts share the outermost context's value. The value is kept in a context variable so that each
+    thread & asyncio task has its own, and work run via sync_to_async() or
+    allianceutils.middleware.current_user.copy_context_callable() sees the value of the code that started it.
+
+    Subclasses must set context_var (see make_context_var()) and implement create()
+    """
+    context_var: Any
+    # one entry per nested __enter__(): the token to restore the previous value with, or None if the value was shared
+    _tokens: List[Optional[object]]
+
+    def __init__(self):
+        self._tokens = []
+
+    def create(self) -> Any:
+        """
+        Create the value for a new outermost context
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def get_current(cls) -> Any:
+        """
+        Get the value of the active context, or None if there is no active context
+        """
+        return cls.context_var.get()
+
+    def __enter__(self) -> Any:
+        value = self.context_var.get()
+        if value is None:
+            value = self.create()
+            self._tokens.append(self.context_var.set(value))
+        else:
+            self._tokens.append(None)
+        return value
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        token = self._tokens.pop()
+        if token is not None:
+            self.context_var.reset(token)
@@ -1,9 +1,13 @@
 from functools import wraps
+from typing import Callable
+from typing import Optional
 
 from django.conf import settings
 from django.utils.decorators import available_attrs
 from django.views.decorators.gzip import gzip_page
 
+from allianceutils.middleware.performance_budget import PerformanceBudget
+
 
 def gzip_page_ajax(func):
     """
@@ -23,3 +27,22 @@ def gzip_page_ajax(func):
             return gzipped_func(request, *args, **kwargs)
         return func(request, *args, **kwargs)
     return conditional_gzip_func
+
+
+def performance_budget(
+    queries: Optional[int] = None,
+    db_time: Optional[float] = None,
+    time: Optional[float] = None,
+    response_size: Optional[int] = None,
+) -> Callable:
+    """
+    Set the budget that PerformanceBudgetMiddleware checks requests to this view against
+    - times are in seconds, response_size is in bytes
+    - for class-based views decorate the result of as_view()
+    """
+    budget = PerformanceBudget(queries=queries, db_time=db_time, time=time, response_size=response_size)
+
+    def decorator(view_func: Callable) -> Callable:
+        view_func.performance_budget = budget
+        return view_func
+    return decorator
@@ -0,0 +1,18 @@
+from django.core.exceptions import PermissionDenied
+from django.http import HttpRequest
+from django.http import JsonResponse
+
+from allianceutils.middleware.query_count import get_query_profile_stats
+
+
+def query_count_stats(request: HttpRequest) -> JsonResponse:
+    """
+    Dump the per-view query statistics sampled by QueryCountMiddleware in this process (staff only)
+
+    Samples are kept in memory so each server process has its own statistics
+    """
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_staff:
+        raise PermissionDenied()
+    stats = get_query_profile_stats()
+    return JsonResponse({'views': {view_name: view_stats._asdict() for view_name, view_stats in stats.items()}})
@@ -1,22 +1,63 @@
+import asyncio
 import base64
+from concurrent.futures import ThreadPoolExecutor
+import json
 import threading
 from typing import Callable
 from typing import Dict
 from typing import Optional
+import unittest
+from unittest.mock import Mock
 from unittest.mock import patch
 import warnings
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.exceptions import PermissionDenied
+from django.db import connection
+from django.db import connections
+from django.http import HttpResponse
+from django.http import JsonResponse
 from django.test import Client
 from django.test import override_settings
+from django.test import RequestFactory
 from django.test import TestCase
 from django.urls import reverse
+from django.utils.functional import SimpleLazyObject
 
-# Compensation for the fact that django or other middleware may do some internal queries
+from allianceutils.auth.models import profile_identity_map
+from allianceutils.auth.permission_cache import cached_has_perm
+from allianceutils.auth.permission_cache import cached_has_perms
+from allianceutils.auth.permission_cache import permission_cache
 from allianceutils.middleware import CurrentUserMiddleware
+from allianceutils.middleware import HttpAuthMiddleware
+from allianceutils.middleware import PerformanceBudgetMiddleware
+from allianceutils.middleware import PermissionProfileMiddleware
+from allianceutils.middleware import ProfileIdentityMapMiddleware
+from allianceutils.middleware import QueryCountMiddleware
+from allianceutils.middleware.current_user import copy_context_callable
+from allianceutils.middleware.current_user import submit_with_context
+from allianceutils.middleware.performance_budget import PerformanceBudget
+from allianceutils.middleware.performance_budget import PerformanceBudgetExceeded
+from allianceutils.middleware.query_count import clear_query_profile_samples
+from allianceutils.middleware.query_count import get_query_profile_stats
+from allianceutils.middleware.query_count import normalize_sql
+from allianceutils.middleware.query_count import QueryCounter
+from allianceutils.views.query_count import query_count_stats
 from test_allianceutils.tests.middleware.views import reset_thread_wait_barrier
 
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:
+    sync_to_async = None
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+# Compensation for the fact that django or other middleware may do some internal queries
 QUERY_COUNT_OVERHEAD = 0
 
 def execute_request(client: object,
@@ -124,6 +165,99 @@ class CurrentUserMiddlewareTestCase(TestCase):
         with self.assertRaisesRegex(KeyError, f"Thread .* not already registered with CurrentUserMiddleware"):
             CurrentUserMiddleware.get_user()
 
+    def test_thread_pool(self):
+        """
+        Work submitted to a thread pool only sees the current user if the context is copied
+        """
+        def get_response(request):
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                with self.assertRaises(KeyError):
+                    executor.submit(CurrentUserMiddleware.get_user).result()
+                user = submit_with_context(executor, CurrentUserMiddleware.get_user).result()
+                wrapped_user = executor.submit(copy_context_callable(CurrentUserMiddleware.get_user)).result()
+            return JsonResponse({'user_id': user['user_id'], 'wrapped_user_id': wrapped_user['user_id']})
+
+        request = RequestFactory().get('/')
+        request.user = get_user_model().objects.get(id=self.user_id)
+        response = CurrentUserMiddleware(get_response)(request)
+        self.assertEqual(json.loads(response.content), {'user_id': self.user_id, 'wrapped_user_id': self.user_id})
+        with self.assertRaises(KeyError):
+            CurrentUserMiddleware.get_user()
+
+    def test_lazy_user(self):
+        """
+        The user is only loaded if get_user() is called
+        """
+        load_user = Mock(side_effect=lambda: get_user_model().objects.get(id=self.user_id))
+
+        def get_response(request):
+            return HttpResponse('')
+
+        request = RequestFactory().get('/')
+        request.user = SimpleLazyObject(load_user)
+        CurrentUserMiddleware(get_response)(request)
+        self.assertEqual(load_user.call_count, 0)
+
+        def get_response(request):
+            CurrentUserMiddleware.get_user()
+            return JsonResponse(CurrentUserMiddleware.get_user())
+
+        request = RequestFactory().get('/', REMOTE_ADDR='10.1.2.3')
+        request.user = SimpleLazyObject(load_user)
+        response = CurrentUserMiddleware(get_response)(request)
+        self.assertEqual(load_user.call_count, 1)
+        self.assertEqual(json.loads(response.content), {'user_id': self.user_id, 'remote_ip': '10.1.2.3'})
+
+    @unittest.skipIf(sync_to_async is None or contextvars is None, 'async middleware requires asgiref & contextvars')
+    def test_async(self):
+        """
+        Concurrent async requests on the same thread each see their own user
+        """
+        async def get_response(request):
+            await asyncio.sleep(0)
+            return JsonResponse({'user_id': CurrentUserMiddleware.get_user()['user_id']})
+
+        middleware = CurrentUserMiddleware(get_response)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+
+        other_user = get_user_model().objects.create_user(email='other@example.com', password=self.password)
+        requests = []
+        for user in (get_user_model().objects.get(id=self.user_id), other_user, AnonymousUser()):
+            request = RequestFactory().get('/')
+            request.user = user
+            requests.append(request)
+
+        async def run_requests():
+            return await asyncio.gather(*(middleware(request) for request in requests))
+
+        responses = asyncio.run(run_requests())
+        self.assertEqual(
+            [json.loads(response.content)['user_id'] for response in responses],
+            [self.user_id, other_user.id, None],
+        )
+
+    @unittest.skipIf(sync_to_async is None or contextvars is None, 'async middleware requires asgiref & contextvars')
+    def test_async_lazy_user(self):
+        """
+        Under async middleware a lazy user is loaded outside of the event loop so get_user() can be called from a
+        coroutine
+        """
+        user = get_user_model().objects.get(id=self.user_id)
+
+        def load_user():
+            with self.assertRaises(RuntimeError):
+                # loading the user from the session would raise SynchronousOnlyOperation if called from the event loop
+                asyncio.get_running_loop()
+            return user
+
+        async def get_response(request):
+            return JsonResponse(CurrentUserMiddleware.get_user())
+
+        request = RequestFactory().get('/', REMOTE_ADDR='10.1.2.3')
+        request.user = SimpleLazyObject(Mock(side_effect=load_user))
+        response = asyncio.run(CurrentUserMiddleware(get_response)(request))
+        self.assertEqual(json.loads(response.content), {'user_id': self.user_id, 'remote_ip': '10.1.2.3'})
+
 
 class QueryCountMiddlewareTestCase(TestCase):
 
@@ -244,6 +378,206 @@ class QueryCountMiddlewareTestCase(TestCase):
         self.assert_warning_count(0, 0, settings.QUERY_COUNT_WARNING_THRESHOLD - QUERY_COUNT_OVERHEAD - 1)
         self.assert_warning_count(0, 1, settings.QUERY_COUNT_WARNING_THRESHOLD - QUERY_COUNT_OVERHEAD)
 
+    @override_settings(
+        MIDDLEWARE=settings.MIDDLEWARE + ('allianceutils.middleware.QueryCountMiddleware',),
+        QUERY_COUNT_ALIAS_WARNING_THRESHOLDS={'default': 5, 'no_such_alias': 1},
+    )
+    def test_alias_threshold(self):
+        """
+        Per-alias thresholds are checked independently of the total threshold
+        """
+        self.assert_warning_count(0, 0, 5 - QUERY_COUNT_OVERHEAD - 1)
+        self.assert_warning_count(0, 1, 5 - QUERY_COUNT_OVERHEAD)
+        self.assert_warning_count(0, 2, settings.QUERY_COUNT_WARNING_THRESHOLD - QUERY_COUNT_OVERHEAD)
+        self.assert_warning_count(0, 0, 0)
+
+    def test_counter_per_alias(self):
+        """
+        QueryCounter counts queries per alias on every connection
+        """
+        counter = QueryCounter()
+        with counter.wrap_connections():
+            for alias in connections:
+                self.assertIn(counter, connections[alias].execute_wrappers)
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+                cursor.execute('SELECT 1')
+        for alias in connections:
+            self.assertNotIn(counter, connections[alias].execute_wrappers)
+        self.assertEqual(counter.count, 2)
+        self.assertEqual(counter.counts, {'default': 2})
+
+    def test_counter_timing(self):
+        """
+        QueryCounter records time, executemany() calls and the slowest query
+        """
+        counter = QueryCounter()
+        with counter.wrap_connections():
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+                table = connection.ops.quote_name(get_user_model()._meta.db_table)
+                cursor.executemany(f'UPDATE {table} SET id = id WHERE id = %s', [(1,), (2,)])
+        self.assertEqual(counter.count, 2)
+        self.assertEqual(counter.many_count, 1)
+        self.assertGreater(counter.time, 0)
+        self.assertGreaterEqual(counter.time, counter.slowest_time)
+        self.assertIn(counter.slowest_sql, ('SELECT 1', f'UPDATE {table} SET id = id WHERE id = %s'))
+        self.assertEqual(counter.slowest_alias, 'default')
+
+    @override_settings(MIDDLEWARE=settings.MIDDLEWARE + ('allianceutils.middleware.QueryCountMiddleware',))
+    def test_server_timing(self):
+        """
+        Server-Timing header is only added when QUERY_COUNT_SERVER_TIMING is set
+        """
+        data = {'count': '3', 'throw_exception': 'False'}
+        response = self.client.post(reverse('middleware:run_queries'), data)
+        self.assertFalse(response.has_header('Server-Timing'))
+
+        with override_settings(QUERY_COUNT_SERVER_TIMING=True):
+            response = self.client.post(reverse('middleware:run_queries'), data)
+        self.assertRegex(response['Server-Timing'], r'^db;dur=\d+\.\d{3};desc="3 queries"$')
+
+    def test_normalize_sql(self):
+        self.assertEqual(
+            normalize_sql('SELECT "t1"."id" FROM "t1" WHERE "t1"."id" = %s AND "t1"."name" = \'it\'\'s\' LIMIT 21'),
+            'SELECT "t1"."id" FROM "t1" WHERE "t1"."id" = ? AND "t1"."name" = ? LIMIT ?',
+        )
+        self.assertEqual(
+            normalize_sql('SELECT a\n  FROM b WHERE c IN (1, 2, 3) OR d IN (%s, %s) OR e = %(e)s'),
+            'SELECT a FROM b WHERE c IN (...) OR d IN (...) OR e = ?',
+        )
+
+    def test_counter_fingerprints(self):
+        """
+        Fingerprints are counted & bounded
+        """
+        counter = QueryCounter(fingerprint=True, max_fingerprints=2)
+        with counter.wrap_connections():
+            with connection.cursor() as cursor:
+                for i in range(3):
+                    cursor.execute(f'SELECT {i}')
+                cursor.execute('SELECT 1, 2')
+                cursor.execute('SELECT 1, 2, 3')
+        self.assertEqual(counter.count, 5)
+        self.assertEqual(counter.fingerprints_dropped, 1)
+        self.assertEqual([(fp.sql, fp.count) for fp in counter.get_repeated_fingerprints(1)], [('SELECT ?', 3)])
+        self.assertIn('test_counter_fingerprints', counter.fingerprints['SELECT ?'].frame)
+        self.assertIsNone(counter.fingerprints['SELECT ?, ?'].frame)
+
+        counter = QueryCounter()
+        with counter.wrap_connections():
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+        self.assertIsNone(counter.fingerprints)
+
+    @override_settings(
+        MIDDLEWARE=settings.MIDDLEWARE + ('allianceutils.middleware.QueryCountMiddleware',),
+        QUERY_COUNT_DUPLICATE_THRESHOLD=3,
+    )
+    def test_duplicate_threshold(self):
+        """
+        Repeated queries are logged along with the application code that ran them
+        """
+        self.assert_warning_count(0, 0, 3)
+        self.assert_warning_count(0, 1, 4)
+        self.assert_warning_count(0, 2, settings.QUERY_COUNT_WARNING_THRESHOLD)
+
+        with patch('allianceutils.middleware.query_count.logger.warning', autospec=True) as mock_logger_warning:
+            self.client.post(reverse('middleware:run_queries'), {'count': '4', 'throw_exception': 'False'})
+        message = mock_logger_warning.call_args[0][0]
+        self.assertIn('4x SELECT ?', message)
+        self.assertRegex(message, r'at .*middleware[/\\]views\.py:\d+ in run_queries')
+
+    @override_settings(
+        MIDDLEWARE=settings.MIDDLEWARE + ('allianceutils.middleware.QueryCountMiddleware',),
+        QUERY_COUNT_SAMPLE_RATE=2,
+        QUERY_COUNT_SAMPLE_BUFFER_SIZE=3,
+    )
+    def test_sampling(self):
+        """
+        1 in QUERY_COUNT_SAMPLE_RATE requests are aggregated per view
+        """
+        clear_query_profile_samples()
+        self.addCleanup(clear_query_profile_samples)
+        for count in (1, 100, 2, 100, 3, 100, 4, 100):
+            self.client.post(reverse('middleware:run_queries'), {'count': str(count), 'throw_exception': 'False'})
+
+        stats = get_query_profile_stats()
+        self.assertEqual(list(stats.keys()), ['middleware:run_queries'])
+        # buffer only keeps the 3 most recent samples
+        view_stats = stats['middleware:run_queries']
+        self.assertEqual(view_stats.samples, 3)
+        self.assertEqual((view_stats.count_p50, view_stats.count_p95, view_stats.count_max), (3, 4, 4))
+        self.assertGreaterEqual(view_stats.time_max, view_stats.time_p95)
+        self.assertGreaterEqual(view_stats.time_p95, view_stats.time_p50)
+
+        # no auth middleware
+        request = RequestFactory().get(reverse('middleware:query_count_stats'))
+        with self.assertRaises(PermissionDenied):
+            query_count_stats(request)
+
+        request.user = AnonymousUser()
+        with self.assertRaises(PermissionDenied):
+            query_count_stats(request)
+
+        request.user = get_user_model()(is_staff=True)
+        response = query_count_stats(request)
+        self.assertEqual(json.loads(response.content)['views']['middleware:run_queries']['count_max'], 4)
+
+    @override_settings(QUERY_COUNT_SAMPLE_RATE=2, QUERY_COUNT_WARNING_THRESHOLD=1)
+    def test_sampling_skips_unsampled_requests(self):
+        """
+        Requests that aren't sampled don't count queries at all
+        """
+        clear_query_profile_samples()
+        self.addCleanup(clear_query_profile_samples)
+        middleware = QueryCountMiddleware(lambda request: HttpResponse(''))
+        patch_wrap_connections = patch.object(
+            QueryCounter, 'wrap_connections', autospec=True, side_effect=QueryCounter.wrap_connections
+        )
+        with patch_wrap_connections as wrap_connections:
+            sampled, unsampled = RequestFactory().get('/'), RequestFactory().get('/')
+            middleware(sampled)
+            self.assertEqual(wrap_connections.call_count, 1)
+            middleware(unsampled)
+            self.assertEqual(wrap_connections.call_count, 1)
+        self.assertTrue(sampled.querycountmiddleware_sampled)
+        self.assertFalse(unsampled.querycountmiddleware_sampled)
+        self.assertEqual(get_query_profile_stats()['<unresolved>'].samples, 1)
+
+    @unittest.skipIf(sync_to_async is None or contextvars is None, 'async middleware requires asgiref & contextvars')
+    def test_async(self):
+        """
+        Async middleware attributes queries run in other threads to the request that ran them
+        """
+        async def get_response(request):
+            def run_queries():
+                with connection.cursor() as cursor:
+                    for i in range(int(request.GET['count'])):
+                        cursor.execute('SELECT 1')
+            # each request's queries run in a different thread
+            await asyncio.gather(
+                sync_to_async(run_queries, thread_sensitive=False)(),
+                sync_to_async(run_queries, thread_sensitive=False)(),
+            )
+            return HttpResponse('')
+
+        middleware = QueryCountMiddleware(get_response)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+
+        async def run_requests():
+            requests = [RequestFactory().get('/', {'count': count}) for count in (3, 5)]
+            responses = await asyncio.gather(*(middleware(request) for request in requests))
+            return requests, responses
+
+        with override_settings(QUERY_COUNT_SERVER_TIMING=True):
+            requests, responses = asyncio.run(run_requests())
+        self.assertEqual([request.querycountmiddleware_query_count for request in requests], [6, 10])
+        self.assertRegex(responses[1]['Server-Timing'], r'desc="10 queries"$')
+
+        sync_middleware = QueryCountMiddleware(lambda request: HttpResponse(''))
+        self.assertFalse(asyncio.iscoroutinefunction(sync_middleware))
+
     @override_settings(MIDDLEWARE=settings.MIDDLEWARE + ('allianceutils.middleware.QueryCountMiddleware',))
     def test_query_count_threaded(self):
         """
@@ -304,3 +638,234 @@ class HttpAuthMiddlewareTestCase(TestCase):
         auth_headers = {'HTTP_AUTHORIZATION': 'Basic ' + str(base64.b64encode(f'{self.username}:{self.password}'.encode()), 'utf-8')}
         resp = self.client.get(path="/", **auth_headers)
         self.assertEqual(resp.status_code, 404)
+
+
+    @override_settings(MIDDLEWARE=settings.MIDDLEWARE + ('allianceutils.middleware.HttpAuthMiddleware',), HTTP_AUTH_USERNAME=username, HTTP_AUTH_PASSWORD=password)
+    def test_site_inaccessible_with_malformed_auth(self):
+        for authorization in ('Basic', 'Basic !!!', 'Bearer abc', 'Basic ' + str(base64.b64encode(b'no-colon'), 'utf-8')):
+            resp = self.client.get(path="/", HTTP_AUTHORIZATION=authorization)
+            self.assertEqual(resp.status_code, 401)
+
+    @override_settings(MIDDLEWARE=settings.MIDDLEWARE + ('allianceutils.middleware.HttpAuthMiddleware',), HTTP_AUTH_USERNAME=username)
+    def test_site_inaccessible_without_password(self):
+        for credentials in (f'{self.username}:', f'{self.username}:None', ':'):
+            auth_headers = {'HTTP_AUTHORIZATION': 'Basic ' + str(base64.b64encode(credentials.encode()), 'utf-8')}
+            resp = self.client.get(path="/", **auth_headers)
+            self.assertEqual(resp.status_code, 401)
+
+    @override_settings(
+        MIDDLEWARE=settings.MIDDLEWARE + ('allianceutils.middleware.HttpAuthMiddleware',),
+        HTTP_AUTH_USERNAME=username,
+        HTTP_AUTH_PASSWORD=password,
+        HTTP_AUTH_EXEMPT_PATHS=[r'^health/$', r'^static/'],
+    )
+    def test_exempt_paths(self):
+        self.assertEqual(self.client.get(path="/health/").status_code, 404)
+        self.assertEqual(self.client.get(path="/static/app.js").status_code, 404)
+        self.assertEqual(self.client.get(path="/health/check/").status_code, 401)
+        self.assertEqual(self.client.get(path="/").status_code, 401)
+
+    def test_settings_reloaded(self):
+        """
+        Credentials are precomputed but are reloaded if the settings change
+        """
+        middleware = HttpAuthMiddleware(lambda request: HttpResponse(''))
+
+        def get_status(username, password):
+            request = RequestFactory().get('/')
+            request.META['HTTP_AUTHORIZATION'] = 'Basic ' + str(base64.b64encode(f'{username}:{password}'.encode()), 'utf-8')
+            return middleware(request).status_code
+
+        self.assertEqual(get_status('a', 'b'), 200)
+        with override_settings(HTTP_AUTH_USERNAME=self.username, HTTP_AUTH_PASSWORD=self.password):
+            self.assertEqual(get_status('a', 'b'), 401)
+            self.assertEqual(get_status(self.username, self.password), 200)
+            with override_settings(HTTP_AUTH_PASSWORD='new password'):
+                self.assertEqual(get_status(self.username, self.password), 401)
+                self.assertEqual(get_status(self.username, 'new password'), 200)
+        self.assertEqual(get_status('a', 'b'), 200)
+
+
+@override_settings(MIDDLEWARE=settings.MIDDLEWARE + ('allianceutils.middleware.PerformanceBudgetMiddleware',))
+class PerformanceBudgetMiddlewareTestCase(TestCase):
+
+    def assert_budget_warnings(self, expected_warnings: int, url_path: str, data: Dict[str, str], method: str = 'get'):
+        with patch('allianceutils.middleware.performance_budget.logger.warning', autospec=True) as mock_logger_warning:
+            getattr(self.client, method)(url_path, data)
+        self.assertEqual(mock_logger_warning.call_count, expected_warnings)
+        return mock_logger_warning
+
+    def test_decorator(self):
+        url_path = reverse('middleware:budgeted_queries')
+        self.assert_budget_warnings(0, url_path, {'count': '2'})
+        mock_logger_warning = self.assert_budget_warnings(1, url_path, {'count': '3'})
+        self.assertIn('ran 3 queries (budget 2)', mock_logger_warning.call_args[0][0])
+        self.assertIn('(middleware:budgeted_queries)', mock_logger_warning.call_args[0][0])
+
+        with override_settings(PERFORMANCE_BUDGET_STRICT=True):
+            self.client.get(url_path, {'count': '2'})
+            with self.assertRaisesRegex(PerformanceBudgetExceeded, r'ran 3 queries \(budget 2\)'):
+                self.client.get(url_path, {'count': '3'})
+
+    @override_settings(
+        PERFORMANCE_BUDGETS={'middleware:run_queries': {'queries': 5, 'db_time': 60}},
+        PERFORMANCE_BUDGET_DEFAULT=PerformanceBudget(queries=1, response_size=5),
+    )
+    def test_settings(self):
+        """
+        Decorator budget takes precedence over settings; view name budget takes precedence over the default budget
+        """
+        run_queries_path = reverse('middleware:run_queries')
+        self.assert_budget_warnings(0, run_queries_path, {'count': '5', 'throw_exception': 'False'}, 'post')
+        self.assert_budget_warnings(1, run_queries_path, {'count': '6', 'throw_exception': 'False'}, 'post')
+        self.assert_budget_warnings(0, reverse('middleware:budgeted_queries'), {'count': '2'})
+
+        # default budget: the JSON response is more than 5 bytes
+        mock_logger_warning = self.assert_budget_warnings(1, reverse('middleware:query_overhead'), {})
+        self.assertIn('bytes (budget 5)', mock_logger_warning.call_args[0][0])
+
+    @override_settings(PERFORMANCE_BUDGET_DEFAULT={'time': 0, 'db_time': 0})
+    def test_time(self):
+        mock_logger_warning = self.assert_budget_warnings(1, reverse('middleware:query_overhead'), {})
+        self.assertRegex(mock_logger_warning.call_args[0][0], r'spent .*ms in the database \(budget 0.0ms\), took .*ms \(budget 0.0ms\)')
+
+    def test_query_count_threshold(self):
+        """
+        Views that raise request.QUERY_COUNT_WARNING_THRESHOLD raise the query budget by the same amount
+        """
+        url_path = reverse('middleware:budgeted_queries')
+        self.assert_budget_warnings(0, url_path, {'count': '4', 'extra': '2'})
+        self.assert_budget_warnings(1, url_path, {'count': '5', 'extra': '2'})
+
+        # QueryCountMiddleware setting the threshold isn't a change made by the view
+        with self.settings(MIDDLEWARE=settings.MIDDLEWARE + ('allianceutils.middleware.QueryCountMiddleware',)):
+            self.assert_budget_warnings(1, url_path, {'count': '3'})
+            self.assert_budget_warnings(0, url_path, {'count': '3', 'extra': '1'})
+
+        # a falsy threshold disables query count checks
+        self.assert_budget_warnings(0, url_path, {'count': '5', 'extra': str(-settings.QUERY_COUNT_WARNING_THRESHOLD)})
+
+    @unittest.skipIf(sync_to_async is None or contextvars is None, 'async middleware requires asgiref & contextvars')
+    def test_async(self):
+        """
+        Async middleware counts queries run in other threads, including when nested with QueryCountMiddleware
+        """
+        async def get_response(request):
+            def run_queries():
+                with connection.cursor() as cursor:
+                    for i in range(int(request.GET['count'])):
+                        cursor.execute('SELECT 1')
+            await sync_to_async(run_queries, thread_sensitive=False)()
+            return HttpResponse('')
+
+        middleware = PerformanceBudgetMiddleware(QueryCountMiddleware(get_response))
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+
+        async def run_request(count):
+            request = RequestFactory().get('/', {'count': count})
+            await middleware(request)
+            return request
+
+        with override_settings(PERFORMANCE_BUDGET_DEFAULT=PerformanceBudget(queries=3)):
+            with patch('allianceutils.middleware.performance_budget.logger.warning', autospec=True) as mock_logger_warning:
+                request = asyncio.run(run_request(3))
+                self.assertEqual(mock_logger_warning.call_count, 0)
+                self.assertEqual(request.querycountmiddleware_query_count, 3)
+                asyncio.run(run_request(4))
+                self.assertEqual(mock_logger_warning.call_count, 1)
+            self.assertIn('ran 4 queries (budget 3)', mock_logger_warning.call_args[0][0])
+
+        sync_middleware = PerformanceBudgetMiddleware(lambda request: HttpResponse(''))
+        self.assertFalse(asyncio.iscoroutinefunction(sync_middleware))
+
+
+class PermissionProfileMiddlewareTestCase(TestCase):
+    def setUp(self):
+        self.user = Mock()
+        self.user.has_perm.side_effect = lambda perm, obj=None: obj is not None
+        self.obj = Mock()
+
+    def view(self, request):
+        with permission_cache():
+            cached_has_perm(self.user, 'app.view_thing')
+            cached_has_perm(self.user, 'app.view_thing', self.obj)
+            cached_has_perm(self.user, 'app.view_thing', self.obj)
+            cached_has_perms(self.user, ['app.change_thing', 'app.delete_thing'], self.obj)
+        return HttpResponse()
+
+    def test_stats(self):
+        calls = []
+        callback = lambda request, response, stats: calls.append(stats)
+        middleware = PermissionProfileMiddleware(self.view)
+        request = RequestFactory().get('/')
+
+        with override_settings(DEBUG=False, PERMISSION_PROFILE_CALLBACK=callback):
+            response = middleware(request)
+        self.assertNotIn('X-Permission-Profile', response)
+
+        stats, = calls
+        self.assertEqual(set(stats), {'app.view_thing', 'app.change_thing', 'app.delete_thing'})
+        view_stats = stats['app.view_thing']
+        self.assertEqual(
+            (view_stats.calls, view_stats.global_calls, view_stats.object_calls, view_stats.cached_calls),
+            (3, 1, 2, 1),
+        )
+        self.assertGreater(view_stats.time, 0)
+        self.assertEqual(stats['app.delete_thing'].object_calls, 1)
+
+        with override_settings(DEBUG=True):
+            response = middleware(request)
+        self.assertRegex(
+            response['X-Permission-Profile'],
+            r'app\.view_thing;calls=3;global=1;object=2;cached=1;dur=[0-9.]+',
+        )
+
+        # nothing is recorded outside of the middleware
+        self.view(request)
+        self.assertEqual(len(calls), 1)
+
+    @unittest.skipIf(sync_to_async is None or contextvars is None, 'async middleware requires asgiref & contextvars')
+    def test_async(self):
+        """
+        Async requests record checks made in other threads
+        """
+        calls = []
+        callback = lambda request, response, stats: calls.append(stats)
+
+        async def get_response(request):
+            return await sync_to_async(self.view, thread_sensitive=False)(request)
+
+        middleware = PermissionProfileMiddleware(get_response)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        with override_settings(DEBUG=True, PERMISSION_PROFILE_CALLBACK=callback):
+            response = asyncio.run(middleware(RequestFactory().get('/')))
+        self.assertIn('app.view_thing;calls=3', response['X-Permission-Profile'])
+        stats, = calls
+        self.assertEqual(stats['app.view_thing'].calls, 3)
+
+
+class ProfileIdentityMapMiddlewareTestCase(TestCase):
+
+    @unittest.skipIf(sync_to_async is None or contextvars is None, 'async middleware requires asgiref & contextvars')
+    def test_async(self):
+        """
+        Each async request has its own map, which is also used by work run in other threads
+        """
+        async def get_response(request):
+            in_request = profile_identity_map.get_current()
+            in_thread = await sync_to_async(profile_identity_map.get_current, thread_sensitive=False)()
+            self.assertIsNotNone(in_request)
+            self.assertIs(in_thread, in_request)
+            await asyncio.sleep(0)
+            return JsonResponse({'map_id': id(in_request)})
+
+        middleware = ProfileIdentityMapMiddleware(get_response)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+
+        async def run_requests():
+            return await asyncio.gather(*(middleware(RequestFactory().get('/')) for i in range(2)))
+
+        responses = asyncio.run(run_requests())
+        map_ids = {json.loads(response.content)['map_id'] for response in responses}
+        self.assertEqual(len(map_ids), 2)
+        self.assertIsNone(profile_identity_map.get_current())
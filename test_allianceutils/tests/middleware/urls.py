@@ -1,5 +1,8 @@
 from django.conf.urls import url
 
+from allianceutils.views.query_count import query_count_stats
+
+from .views import budgeted_queries
 from .views import current_user
 from .views import query_overhead
 from .views import run_queries
@@ -9,7 +12,9 @@ app_name = 'middleware'
 urlpatterns = [
     url(r'^run_queries/$', run_queries, name='run_queries'),
     url(r'^query_overhead/$', query_overhead, name='query_overhead'),
+    url(r'^query_count_stats/$', query_count_stats, name='query_count_stats'),
 
     url(r'^current_user/$', current_user, name='current_user'),
+    url(r'^budgeted_queries/$', budgeted_queries, name='budgeted_queries'),
 
 ]
@@ -10,6 +10,8 @@ from django.http import HttpResponse
 from django.http import JsonResponse
 from django.test.utils import CaptureQueriesContext
 
+from allianceutils.views.decorators import performance_budget
+
 _request_thread_wait_barrier: Optional[threading.Barrier] = None
 
 
@@ -90,3 +92,17 @@ def current_user(request: HttpRequest, **kwargs) -> HttpResponse:
         from django.contrib.auth import get_user_model
         return JsonResponse({'username': get_user_model().objects.get(id=user['user_id']).email})
     return JsonResponse({'username': None})
+
+
+@performance_budget(queries=2)
+def budgeted_queries(request: HttpRequest, **kwargs) -> HttpResponse:
+    """
+    Run a specified number of queries in a view with a budget of 2 queries, optionally raising the query count
+    threshold by `extra`
+    """
+    if 'extra' in request.GET:
+        request.QUERY_COUNT_WARNING_THRESHOLD += int(request.GET['extra'])
+    with connection.cursor() as cursor:
+        for i in range(int(request.GET['count'])):
+            cursor.execute('SELECT 1')
+    return HttpResponse('')
@@ -0,0 +1,24 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:46
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('profile_auth', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserFKMultipleModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('approved_by', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('created_by', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('fk', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='profile_auth.UserFKImmediateModel')),
+            ],
+        ),
+    ]
@@ -46,3 +46,9 @@ class UserFKImmediateModel(models.Model):
 
 class UserFKIndirectModel(models.Model):
     fk = models.ForeignKey(to=UserFKImmediateModel, on_delete=models.CASCADE)
+
+
+class UserFKMultipleModel(models.Model):
+    created_by = models.ForeignKey(to=User, on_delete=models.CASCADE, related_name='+')
+    approved_by = models.ForeignKey(to=User, on_delete=models.CASCADE, related_name='+', null=True)
+    fk = models.ForeignKey(to=UserFKImmediateModel, on_delete=models.CASCADE, null=True)
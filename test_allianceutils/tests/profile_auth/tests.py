@@ -1,8 +1,11 @@
 import io
+from unittest import skipIf
 
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AbstractBaseUser
+from django.contrib.auth.models import Permission
 from django.core.management import call_command
+from django.db import connection
 from django.db import IntegrityError
 from django.forms import IntegerField
 from django.forms import ModelForm
@@ -13,14 +16,38 @@ from django.test.utils import isolate_apps
 from django.urls import reverse
 from django.utils.http import urlencode
 
+from allianceutils.auth.backends import invalidate_permission_snapshots
+from allianceutils.auth.backends import MinimalModelBackend
+from allianceutils.auth.backends import PermissionSnapshotBackendMixin
 from allianceutils.auth.models import GenericUserProfile
 from allianceutils.auth.models import ID_ERROR_PROFILE_RELATED_TABLES
+from allianceutils.auth.models import profile_identity_map
+
+try:
+    from asgiref.sync import async_to_sync
+except ImportError:
+    async_to_sync = None
+
+try:
+    import rules
+except ImportError:
+    rules = None
 
 from .models import AdminProfile
 from .models import CustomerProfile
 from .models import User
 from .models import UserFKImmediateModel
 from .models import UserFKIndirectModel
+from .models import UserFKMultipleModel
+
+
+class SnapshotBackend(PermissionSnapshotBackendMixin, MinimalModelBackend):
+    pass
+
+
+class CachedSnapshotBackend(PermissionSnapshotBackendMixin, MinimalModelBackend):
+    permission_snapshot_timeout = 60
+    permission_snapshot_extra_permissions = ('profile_auth.is_customer', 'profile_auth.is_admin', 'profile_auth.owns')
 
 
 @override_settings(
@@ -299,6 +326,65 @@ class AuthTestCase(TestCase):
         self.assertTrue(form.is_valid())
 
 
+    def test_find_duplicate_emails(self):
+        emails = [
+            'NEW1@example.com',
+            'new2@example.com',
+            'new1@EXAMPLE.com',
+            self.customer1.email.upper(),
+            self.admin1.email,
+        ]
+        with self.assertNumQueries(1):
+            duplicates = User.find_duplicate_emails(emails)
+        self.assertEqual(duplicates.in_batch, {'new1@example.com'})
+        self.assertEqual(duplicates.in_database, {self.customer1.email, self.admin1.email})
+
+        # records being updated don't conflict with themselves
+        with self.assertNumQueries(1):
+            duplicates = User.find_duplicate_emails(emails, exclude_pks=[self.customer1.pk, None])
+        self.assertEqual(duplicates.in_database, {self.admin1.email})
+
+        with self.assertNumQueries(0):
+            duplicates = User.find_duplicate_emails([])
+        self.assertEqual(duplicates, (set(), set()))
+
+        # existing records with mixed case emails are found
+        mixed_case = User.objects.create_user(email='MiXeD.CaSe@Example.com', password='abc123')
+        with self.assertNumQueries(1):
+            duplicates = User.find_duplicate_emails(['mixed.case@example.com', 'MIXED.case@example.com'])
+        self.assertEqual(duplicates.in_database, {'mixed.case@example.com'})
+        duplicates = User.find_duplicate_emails(['mixed.case@example.com'], exclude_pks=[mixed_case.pk])
+        self.assertEqual(duplicates.in_database, set())
+
+    def test_bulk_create_profiles(self):
+        # postgres returns pks from the bulk insert; other databases need an extra query to look them up
+        can_return_pks = getattr(connection.features, 'can_return_rows_from_bulk_insert', None) or \
+            getattr(connection.features, 'can_return_ids_from_bulk_insert', False)
+
+        customers = [CustomerProfile(email=f'Bulk{i}@Example.com', customer_details=f'c{i}') for i in range(3)]
+        with self.assertNumQueries(2 if can_return_pks else 3):
+            created = CustomerProfile.objects.bulk_create_profiles(customers)
+        self.assertEqual(created, customers)
+
+        for i, customer in enumerate(customers):
+            with self.subTest(email=customer.email):
+                self.assertEqual(customer.email, f'bulk{i}@example.com')
+                self.assertIsNotNone(customer.pk)
+                self.assertFalse(customer._state.adding)
+                fetched = User.profiles.get(pk=customer.pk)
+                self.assertIs(type(fetched), CustomerProfile)
+                self.assertEqual(fetched.email, customer.email)
+                self.assertEqual(fetched.customer_details, f'c{i}')
+
+        users = User.objects.bulk_create_profiles([User(email='BulkUser@Example.com')])
+        self.assertEqual(User.objects.get(pk=users[0].pk).email, 'bulkuser@example.com')
+
+        customers[0].email = 'Changed@Example.com'
+        customers[1].customer_details = 'changed'
+        CustomerProfile.objects.bulk_update_profiles(customers, ['email', 'customer_details'])
+        self.assertEqual(CustomerProfile.objects.get(pk=customers[0].pk).email, 'changed@example.com')
+        self.assertEqual(CustomerProfile.objects.get(pk=customers[1].pk).customer_details, 'changed')
+
     def test_middleware(self):
         """
         Standard django middleware returns the right profile type
@@ -455,6 +541,103 @@ class AuthTestCase(TestCase):
                             profile = profile.profile.profile
                         self.assertIs(type(original_profile), type(profile))
 
+    def test_related_profiles_multiple_paths(self):
+        user_ids = list(self.profiles.keys())
+        for created_by_id, approved_by_id in zip(user_ids, reversed(user_ids)):
+            UserFKMultipleModel(created_by_id=created_by_id, approved_by_id=approved_by_id).save()
+
+        operation_query_counts = (
+            # (lookup func, query count for SELECT)
+            (lambda qs: User.objects.select_related_profiles(qs, ['created_by', 'approved_by', 'created_by']), 1),
+            (lambda qs: User.objects.prefetch_related_profiles(qs, ['created_by', 'approved_by']), 7),
+            (lambda qs: User.objects.related_profiles(qs, 'created_by', 'approved_by', 'created_by'), 1),
+            (lambda qs: User.objects.related_profiles(qs, 'created_by', 'approved_by', prefetch=True), 3),
+        )
+
+        for i, (op_func, select_query_count) in enumerate(operation_query_counts):
+            with self.subTest(i):
+                with self.assertNumQueries(select_query_count):
+                    referrers = list(op_func(UserFKMultipleModel.objects.order_by('id')))
+                with self.assertNumQueries(0):
+                    for referrer in referrers:
+                        self.assertIs(type(self.profiles[referrer.created_by_id]), type(referrer.created_by.profile))
+                        self.assertIs(type(self.profiles[referrer.approved_by_id]), type(referrer.approved_by.profile))
+
+    def test_related_profiles_multivalued_path(self):
+        for user_id in self.profiles:
+            immediate = UserFKImmediateModel(fk_id=user_id)
+            immediate.save()
+            UserFKMultipleModel(created_by_id=user_id, fk=immediate).save()
+
+        qs = UserFKImmediateModel.objects.order_by('id')
+
+        with self.assertRaises(ValueError):
+            User.objects.related_profiles(qs, 'userfkmultiplemodel__created_by', prefetch=False)
+
+        with self.assertRaises(ValueError):
+            User.objects.related_profiles(qs, 'userfkmultiplemodel')
+
+        # path is prefetched automatically; profile tables are joined to the prefetch query
+        with self.assertNumQueries(3):
+            immediates = list(User.objects.related_profiles(qs, 'fk', 'userfkmultiplemodel__created_by'))
+        with self.assertNumQueries(0):
+            for immediate in immediates:
+                self.assertIs(type(self.profiles[immediate.fk_id]), type(immediate.fk.profile))
+                for referrer in immediate.userfkmultiplemodel_set.all():
+                    self.assertIs(type(self.profiles[referrer.created_by_id]), type(referrer.created_by.profile))
+
+    def test_related_profiles_no_profile_tables(self):
+        """
+        Paths that end at a profile model need no profile tables so the prefetch query mustn't join anything
+        """
+        qs = User.objects.related_profiles(User.objects.order_by('id'), 'customerprofile', prefetch=True)
+        prefetch_queryset = qs._prefetch_related_lookups[0].queryset
+        self.assertIs(prefetch_queryset.query.select_related, False)
+
+        with self.assertNumQueries(2):
+            users = list(qs)
+        with self.assertNumQueries(0):
+            for user in users:
+                self.assertEqual(type(self.profiles[user.id]) is CustomerProfile, hasattr(user, 'customerprofile'))
+
+    def test_profile_identity_map(self):
+        user_ids = list(self.profiles.keys())
+        for user_id in user_ids:
+            UserFKMultipleModel(created_by_id=user_id, approved_by_id=user_ids[0]).save()
+
+        qs = UserFKMultipleModel.objects.select_related('created_by', 'approved_by').order_by('id')
+
+        # without an identity map every reference to the same user resolves its profile separately
+        referrers = list(qs.all())
+        approved_by = referrers[0].approved_by
+        with self.assertNumQueries(self.get_profile_query_count(approved_by) * len(referrers)):
+            profiles = [referrer.approved_by.profile for referrer in referrers]
+        self.assertIsNot(profiles[0], profiles[1])
+
+        with profile_identity_map():
+            referrers = list(qs.all())
+            with self.assertNumQueries(self.get_profile_query_count(approved_by)):
+                profiles = [referrer.approved_by.profile for referrer in referrers]
+            self.assertTrue(all(profile is profiles[0] for profile in profiles))
+
+            # also shared with records loaded by other queries (including prefetches)
+            with self.assertNumQueries(0):
+                self.assertIs(referrers[0].created_by.profile, profiles[0])
+
+            with self.assertNumQueries(2):
+                fetched = list(UserFKMultipleModel.objects.prefetch_related('approved_by').order_by('id'))
+            with self.assertNumQueries(0):
+                self.assertIs(fetched[1].approved_by.profile, profiles[0])
+
+            # nested contexts share the same map
+            with profile_identity_map():
+                with self.assertNumQueries(1):
+                    self.assertIs(User.objects.get(pk=user_ids[0]).profile, profiles[0])
+
+        # map is discarded at the end of the context
+        with self.assertNumQueries(1 + self.get_profile_query_count(approved_by)):
+            self.assertIsNot(User.objects.get(pk=user_ids[0]).profile, profiles[0])
+
     def test_select_prefetch_related_profile(self):
         # select/prefetch_related_profiles() on User means no extra queries
         # select/prefetch_related_profiles() on something that's already a profile is a nooop
@@ -502,6 +685,50 @@ class AuthTestCase(TestCase):
         self.assertEqual([err.id for err in errors_bad_user], [ID_ERROR_PROFILE_RELATED_TABLES, ID_ERROR_PROFILE_RELATED_TABLES])
         self.assertEqual(errors_good_user, [])
 
+    @skipIf(async_to_sync is None, 'asgiref not installed')
+    def test_async_iterate_profile(self):
+        async def collect(iterable):
+            return [record async for record in iterable]
+
+        querysets = (
+            # (queryset, expected query count)
+            (User.profiles.order_by('id'), 1),
+            (User.objects.select_related_profiles().profiles().order_by('id'), 1),
+            (User.objects.prefetch_related_profiles().order_by('id'), self.PREFETCH_QUERY_COUNT),
+        )
+        for i, (qs, query_count) in enumerate(querysets):
+            with self.subTest(i):
+                with self.assertNumQueries(query_count):
+                    fetched = async_to_sync(collect)(qs.all())
+                with self.assertNumQueries(0):
+                    profiles = [record.profile for record in fetched]
+                self.assertEqual([type(self.profiles[profile.id]) for profile in profiles], [type(p) for p in profiles])
+                self.assertEqual(len(fetched), len(self.profiles))
+
+        # results are cached like sync iteration
+        qs = User.profiles.order_by('id')
+        with self.assertNumQueries(1):
+            fetched = async_to_sync(collect)(qs)
+        with self.assertNumQueries(0):
+            self.assertEqual(async_to_sync(collect)(qs), fetched)
+            self.assertEqual(list(qs), fetched)
+        qs = User.profiles.order_by('id')
+        fetched = list(qs)
+        with self.assertNumQueries(0):
+            self.assertEqual(async_to_sync(collect)(qs), fetched)
+
+        # aiterator() streams in chunks without caching
+        qs = User.profiles.order_by('id')
+        with self.assertNumQueries(1):
+            fetched = async_to_sync(collect)(qs.aiterator(chunk_size=2))
+        self.assertEqual([type(self.profiles[profile.id]) for profile in fetched], [type(p) for p in fetched])
+        self.assertIsNone(qs._result_cache)
+
+        # plain user records still work
+        with self.assertNumQueries(1):
+            fetched = async_to_sync(collect)(User.objects.order_by('id').aiterator())
+        self.assertEqual({type(user) for user in fetched}, {User})
+
     def test_values(self):
         # You're not allowed to call values on a profile list
         qs = User.profiles.select_related_profiles()
@@ -518,3 +745,94 @@ class AuthTestCase(TestCase):
     def test_queryset_with_args(self):
         self.assertEqual(tuple(AdminProfile.objects.all().values_list('email')), (('admin1@example.com',),('admin2@example.com',)))
         self.assertEqual(tuple(AdminProfile.objects.all().values_list('email', flat=True)), ('admin1@example.com', 'admin2@example.com'))
+
+    @skipIf(rules is None, 'django-rules not installed')
+    def test_permission_snapshot(self):
+        rule_checks = []
+
+        @rules.predicate
+        def is_customer(user):
+            rule_checks.append(user.pk)
+            return isinstance(user.profile, CustomerProfile)
+
+        @rules.predicate
+        def is_admin(user):
+            rule_checks.append(('is_admin', user.pk))
+            return isinstance(user.profile, AdminProfile)
+
+        rules.set_perm('profile_auth.is_customer', is_customer)
+        self.addCleanup(rules.remove_perm, 'profile_auth.is_customer')
+        rules.set_perm('profile_auth.is_admin', is_admin)
+        self.addCleanup(rules.remove_perm, 'profile_auth.is_admin')
+
+        # object-only rule: raises AttributeError if checked without an object
+        rules.set_perm('profile_auth.owns', rules.predicate(lambda user, obj: obj.pk == user.pk))
+        self.addCleanup(rules.remove_perm, 'profile_auth.owns')
+
+        @rules.predicate
+        def unlisted(user):
+            rule_checks.append(('unlisted', user.pk))
+            return True
+
+        rules.set_perm('profile_auth.unlisted', unlisted)
+        self.addCleanup(rules.remove_perm, 'profile_auth.unlisted')
+        self.customer1.user_permissions.add(Permission.objects.get_by_natural_key('change_user', 'profile_auth', 'user'))
+
+        other_backends = ['rules.permissions.ObjectPermissionBackend', 'django.contrib.auth.backends.ModelBackend']
+        module = __name__
+        with override_settings(AUTHENTICATION_BACKENDS=[f'{module}.SnapshotBackend'] + other_backends):
+            user = User.objects.get(pk=self.customer1.pk)
+            self.assertTrue(user.has_perm('profile_auth.is_customer'))
+            # without cross-request caching only the permissions actually checked are evaluated
+            self.assertEqual(rule_checks, [self.customer1.pk])
+            self.assertTrue(user.has_perm('profile_auth.change_user'))
+            self.assertFalse(user.has_perm('profile_auth.delete_user'))
+            self.assertFalse(user.has_perm('profile_auth.not_a_permission'))
+
+            # repeated checks are answered from the stored decisions
+            with self.assertNumQueries(0):
+                self.assertTrue(user.has_perm('profile_auth.is_customer'))
+                self.assertTrue(user.has_perm('profile_auth.change_user'))
+                self.assertFalse(user.has_perm('profile_auth.delete_user'))
+                self.assertTrue(user.has_perms(['profile_auth.change_user', 'profile_auth.is_customer']))
+                self.assertFalse(user.has_perm('profile_auth.not_a_permission'))
+            self.assertEqual(rule_checks, [self.customer1.pk])
+
+            # object permissions are not part of the snapshot
+            self.assertTrue(user.has_perm('profile_auth.is_customer', self.admin1))
+            self.assertEqual(len(rule_checks), 2)
+
+            # snapshots only last for the lifetime of the user object
+            admin = User.objects.get(pk=self.admin1.pk)
+            self.assertFalse(admin.has_perm('profile_auth.is_customer'))
+            self.assertFalse(admin.has_perm('profile_auth.change_user'))
+            self.assertEqual(rule_checks[2:], [self.admin1.pk])
+
+            # superusers have every permission
+            admin.is_superuser = True
+            self.assertTrue(admin.has_perm('profile_auth.change_user'))
+
+        rule_checks.clear()
+        with override_settings(AUTHENTICATION_BACKENDS=[f'{module}.CachedSnapshotBackend'] + other_backends):
+            invalidate_permission_snapshots()
+            self.assertTrue(User.objects.get(pk=self.customer1.pk).has_perm('profile_auth.is_customer'))
+            # the snapshot covers django permissions and the listed rules permissions; rules that can't be checked
+            # without an object are left out
+            self.assertCountEqual(rule_checks, [self.customer1.pk, ('is_admin', self.customer1.pk)])
+            rule_checks.clear()
+            user = User.objects.get(pk=self.customer1.pk)
+            self.assertTrue(user.has_perm('profile_auth.is_customer'))
+            self.assertFalse(user.has_perm('profile_auth.is_admin'))
+            self.assertEqual(rule_checks, [])
+            self.assertEqual(user._permission_snapshot.granted, {'profile_auth.change_user', 'profile_auth.is_customer'})
+            self.assertNotIn('profile_auth.owns', user._permission_snapshot.denied)
+            self.assertTrue(user.has_perm('profile_auth.owns', user))
+
+            # unlisted rules are checked normally
+            self.assertTrue(user.has_perm('profile_auth.unlisted'))
+            self.assertEqual(rule_checks, [('unlisted', self.customer1.pk)])
+            rule_checks.clear()
+
+            invalidate_permission_snapshots()
+            self.assertTrue(User.objects.get(pk=self.customer1.pk).has_perm('profile_auth.is_customer'))
+            self.assertCountEqual(rule_checks, [self.customer1.pk, ('is_admin', self.customer1.pk)])
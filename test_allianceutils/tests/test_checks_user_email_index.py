@@ -0,0 +1,26 @@
+from unittest import skipUnless
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase
+
+from allianceutils.checks import check_user_email_index
+from allianceutils.checks import ID_WARNING_USER_EMAIL_INDEX
+
+
+class TestCheckUserEmailIndex(TestCase):
+
+    @skipUnless(connection.vendor == 'postgresql', 'Functional index check only applies to postgresql')
+    def test_missing_index(self):
+        errors = check_user_email_index(None)
+        self.assertEqual([error.id for error in errors], [ID_WARNING_USER_EMAIL_INDEX])
+
+        table = get_user_model()._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(f'CREATE INDEX test_user_email_lower ON {table} (LOWER(email))')
+
+        self.assertEqual(check_user_email_index(None), [])
+
+    @skipUnless(connection.vendor != 'postgresql', 'Check is skipped for databases other than postgresql')
+    def test_not_postgresql(self):
+        self.assertEqual(check_user_email_index(None), [])
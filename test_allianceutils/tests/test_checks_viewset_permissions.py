@@ -0,0 +1,65 @@
+from django.test import override_settings
+from django.test import SimpleTestCase
+from rest_framework import viewsets
+from rest_framework.decorators import action
+from rest_framework.response import Response
+from rest_framework.routers import SimpleRouter
+
+from allianceutils.api.permissions import _permission_tables
+from allianceutils.api.permissions import GenericDjangoViewsetPermissions
+from allianceutils.checks import check_viewset_permission_tables
+from allianceutils.checks import ID_WARNING_VIEWSET_ACTION_PERMISSIONS
+from test_allianceutils.tests.viewset_permissions.models import NinjaTurtleModel
+from test_allianceutils.tests.viewset_permissions.views import NinjaTurtleSerializer
+
+
+class TurtleViewSet(viewsets.ModelViewSet):
+    queryset = NinjaTurtleModel.objects.all()
+    serializer_class = NinjaTurtleSerializer
+    permission_classes = [GenericDjangoViewsetPermissions]
+
+    @action(detail=False)
+    def summary(self, request):
+        return Response({})
+
+
+class MappedTurtleViewSet(TurtleViewSet):
+    class Permissions(GenericDjangoViewsetPermissions):
+        actions_to_perms_map = {
+            'summary': ['%(app_label)s.view_%(model_name)s'],
+        }
+
+    permission_classes = [Permissions]
+
+
+router = SimpleRouter()
+router.register(r'turtle', TurtleViewSet, basename='turtle')
+router.register(r'mapped', MappedTurtleViewSet, basename='mapped')
+
+# this module is used as ROOT_URLCONF
+urlpatterns = router.urls
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class TestCheckViewsetPermissionTables(SimpleTestCase):
+
+    def test_check(self):
+        for viewset in (TurtleViewSet, MappedTurtleViewSet):
+            for permission_class in viewset.permission_classes:
+                _permission_tables.pop((permission_class, viewset), None)
+
+        errors = check_viewset_permission_tables(None)
+        self.assertEqual([(error.id, error.obj) for error in errors], [
+            (ID_WARNING_VIEWSET_ACTION_PERMISSIONS, TurtleViewSet),
+        ])
+        self.assertIn('action summary', errors[0].msg)
+
+        # tables were built eagerly
+        table = _permission_tables[(MappedTurtleViewSet.Permissions, MappedTurtleViewSet)]
+        self.assertEqual(table.model, NinjaTurtleModel)
+        self.assertEqual(table.list_actions, {'list', 'create', 'summary'})
+        self.assertEqual(
+            table.get_actions_to_perms(NinjaTurtleModel)['summary'],
+            ['viewset_permissions.view_ninjaturtlemodel'],
+        )
+        self.assertIn((GenericDjangoViewsetPermissions, TurtleViewSet), _permission_tables)
@@ -1,8 +1,18 @@
+from django.db import connection
+from django.http import QueryDict
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.serializers import CharField
 from rest_framework.serializers import ModelSerializer
+from rest_framework.test import APIRequestFactory
+from rest_framework.viewsets import ReadOnlyModelViewSet
 
+from allianceutils.api import FieldQuery
+from allianceutils.api import OptInFieldsQuerySetMixin
 from allianceutils.api import SerializerOptInFieldsMixin
 from test_allianceutils.tests.profile_auth.models import User
+from test_allianceutils.tests.profile_auth.models import UserFKImmediateModel
+from test_allianceutils.tests.profile_auth.models import UserFKMultipleModel
 
 
 class UserSerializer(SerializerOptInFieldsMixin, ModelSerializer):
@@ -12,6 +22,49 @@ class UserSerializer(SerializerOptInFieldsMixin, ModelSerializer):
         opt_in_only_fields = ("is_active", "is_staff")
 
 
+class BuildTrackingUserSerializer(UserSerializer):
+    built_fields = []
+
+    def build_field(self, field_name, *args, **kwargs):
+        self.built_fields.append(field_name)
+        return super().build_field(field_name, *args, **kwargs)
+
+
+class UserFKMultipleSerializer(SerializerOptInFieldsMixin, ModelSerializer):
+    created_by_email = CharField(source="created_by.email")
+    approved_by = UserSerializer()
+
+    class Meta:
+        model = UserFKMultipleModel
+        fields = ("id", "created_by_email", "approved_by", "fk")
+        opt_in_only_fields = ("approved_by",)
+        field_queries = {
+            "created_by_email": FieldQuery(only=["created_by__email"], select_related=["created_by"]),
+            "approved_by": FieldQuery(select_related=["approved_by"]),
+        }
+
+
+class CopyTrackingUserSerializer(UserSerializer):
+    instances = 0
+
+    def __init__(self, *args, **kwargs):
+        type(self).instances += 1
+        super().__init__(*args, **kwargs)
+
+    def __deepcopy__(self, memo):
+        raise AssertionError("opted out nested serializer was deep copied")
+
+
+class NestedCopyTrackingSerializer(UserFKMultipleSerializer):
+    approved_by = CopyTrackingUserSerializer()
+
+
+class UserFKMultipleViewSet(OptInFieldsQuerySetMixin, ReadOnlyModelViewSet):
+    # approved_by is always joined here; the mixin removes it when the field isn't requested
+    queryset = UserFKMultipleModel.objects.select_related("approved_by").order_by("id")
+    serializer_class = UserFKMultipleSerializer
+
+
 class MockRequest:
     def __init__(self, query_params):
         self.query_params = query_params
@@ -133,3 +186,123 @@ class OptinFieldMixinTestcase(TestCase):
         self.assertTrue("first_name" not in serializer.fields)
         self.assertTrue("is_active" not in serializer.fields)
         self.assertTrue("is_staff" in serializer.fields)
+
+    def test_unrequested_fields_not_built(self):
+        BuildTrackingUserSerializer.built_fields = []
+        serializer = BuildTrackingUserSerializer(context={"request": MockRequest({"include_fields": "email"})})
+        self.assertEqual(list(serializer.fields), ["id", "email"])
+        self.assertEqual(sorted(BuildTrackingUserSerializer.built_fields), ["email", "id"])
+
+    def test_unrequested_nested_serializer_not_copied(self):
+        CopyTrackingUserSerializer.instances = 0
+        serializer = NestedCopyTrackingSerializer(context={"request": MockRequest({})})
+        self.assertEqual(list(serializer.fields), ["id", "created_by_email", "fk"])
+        self.assertEqual(CopyTrackingUserSerializer.instances, 0)
+        # the declared fields on the class are unchanged
+        self.assertIn("approved_by", NestedCopyTrackingSerializer._declared_fields)
+
+        serializer = NestedCopyTrackingSerializer(context={"request": MockRequest({"opt_in_fields": "approved_by"})})
+        with self.assertRaisesRegex(AssertionError, "deep copied"):
+            serializer.fields
+
+    def test_query_params_list(self):
+        request = MockRequest(QueryDict("include_fields=email&include_fields=first_name&opt_in_fields=is_staff"))
+        serializer = UserSerializer(context={"request": request})
+        self.assertEqual(set(serializer.fields), {"id", "email", "first_name", "is_staff"})
+
+    def test_query_params_parsed_once_per_request(self):
+        request = MockRequest({"include_fields": "email", "opt_in_fields": "is_staff"})
+        UserSerializer(context={"request": request})
+        # changes to the query params after the first serializer are not seen
+        request.query_params = {}
+        serializer = UserSerializer(context={"request": request})
+        self.assertEqual(set(serializer.fields), {"id", "email", "is_staff"})
+
+    def test_opt_in_fields_are_not_substrings(self):
+        context = {"request": MockRequest({"include_fields": "email", "opt_in_fields": "is_staff,last_name_initial"})}
+        serializer = UserSerializer(context=context)
+        self.assertTrue("is_staff" in serializer.fields)
+        self.assertTrue("last_name" not in serializer.fields)
+
+
+class OptInFieldsQuerySetMixinTestCase(TestCase):
+    def setUp(self):
+        creator = User.objects.create(email="creator@example.com", first_name="Creator")
+        approver = User.objects.create(email="approver@example.com", first_name="Approver")
+        immediate = UserFKImmediateModel.objects.create(fk=creator)
+        self.record = UserFKMultipleModel.objects.create(created_by=creator, approved_by=approver, fk=immediate)
+
+    def get_list(self, **query_params):
+        view = UserFKMultipleViewSet.as_view({"get": "list"})
+        request = APIRequestFactory().get("", query_params)
+        with CaptureQueriesContext(connection) as queries:
+            response = view(request).render()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), 1, [q["sql"] for q in queries])
+        return response.data, queries[0]["sql"]
+
+    def test_default_fields(self):
+        data, sql = self.get_list()
+        self.assertEqual(data[0]["created_by_email"], "creator@example.com")
+        self.assertNotIn("approved_by", data[0])
+        # only created_by is joined, and only its email is loaded
+        self.assertEqual(sql.count(" JOIN "), 1)
+        self.assertNotIn('"first_name"', sql)
+        self.assertIn('"email"', sql)
+
+    def test_opt_in_relation(self):
+        data, sql = self.get_list(opt_in_fields="approved_by")
+        self.assertEqual(data[0]["approved_by"]["first_name"], "Approver")
+        self.assertEqual(sql.count(" JOIN "), 2)
+        self.assertIn('"first_name"', sql)
+
+    def test_include_fields(self):
+        data, sql = self.get_list(include_fields="fk")
+        self.assertEqual(data, [{"id": self.record.id, "fk": self.record.fk_id}])
+        self.assertEqual(sql.count(" JOIN "), 0)
+        self.assertNotIn('"created_by_id"', sql)
+        self.assertNotIn('"approved_by_id"', sql)
+
+    def test_undeclared_field_loads_all_columns(self):
+        class UndeclaredSerializer(UserFKMultipleSerializer):
+            created_by_name = CharField(source="created_by.first_name")
+
+            class Meta(UserFKMultipleSerializer.Meta):
+                fields = UserFKMultipleSerializer.Meta.fields + ("created_by_name",)
+
+        class UndeclaredViewSet(UserFKMultipleViewSet):
+            serializer_class = UndeclaredSerializer
+
+        view = UndeclaredViewSet.as_view({"get": "list"})
+        response = view(APIRequestFactory().get("")).render()
+        self.assertEqual(response.data[0]["created_by_name"], "Creator")
+        self.assertEqual(response.data[0]["created_by_email"], "creator@example.com")
+
+    def test_pruned_once_per_request(self):
+        serializers_built = []
+        querysets = []
+
+        class CountingViewSet(UserFKMultipleViewSet):
+            def initial(self, request, *args, **kwargs):
+                super().initial(request, *args, **kwargs)
+                # eg GenericDjangoViewsetPermissions.get_model()
+                self.get_queryset()
+
+            def get_queryset(self):
+                queryset = super().get_queryset()
+                querysets.append(queryset)
+                return queryset
+
+            def get_serializer(self, *args, **kwargs):
+                serializer = super().get_serializer(*args, **kwargs)
+                serializers_built.append(serializer)
+                return serializer
+
+        view = CountingViewSet.as_view({"get": "list"})
+        response = view(APIRequestFactory().get("")).render()
+        self.assertEqual(response.data[0]["created_by_email"], "creator@example.com")
+        # once for pruning the queryset & once for the response
+        self.assertEqual(len(serializers_built), 2)
+        # each call gets its own copy
+        self.assertEqual(len(querysets), 2)
+        self.assertIsNot(querysets[0], querysets[1])
@@ -1,10 +1,41 @@
+import asyncio
+from decimal import Decimal
+from unittest import skipIf
 from unittest.mock import Mock
+from unittest.mock import patch
 
+from django.http import HttpResponse
 from django.test import override_settings
+from django.test import RequestFactory
 from django.test import TestCase
+import rules
 
 from allianceutils.api.permissions import GenericDjangoViewsetPermissions
 from allianceutils.api.permissions import SimpleDjangoObjectPermissions
+from allianceutils.auth.permission_cache import cached_has_perm
+from allianceutils.auth.permission_cache import clear_permission_cache
+from allianceutils.auth.permission_cache import permission_cache
+from allianceutils.auth.permission_profile import permission_profile
+from allianceutils.middleware import PermissionCacheMiddleware
+from allianceutils.rules import batchable
+from allianceutils.rules import has_any_perms
+from allianceutils.rules import has_any_perms_batch
+from allianceutils.rules import has_perm
+from allianceutils.rules import has_perm_batch
+from allianceutils.rules import has_perms
+from allianceutils.rules import has_perms_batch
+from test_allianceutils.tests.profile_auth.models import User
+from test_allianceutils.tests.viewset_permissions.models import NinjaTurtleModel
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:
+    sync_to_async = None
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
 
 
 class PermissionTestCase(TestCase):
@@ -65,3 +96,157 @@ class PermissionTestCase(TestCase):
 
         with self.assertRaises(AssertionError):
             SimpleDjangoObjectPermissions().has_object_permission(request, view, obj)
+
+    def test_permission_cache(self):
+        """
+        Permission checks are only made once per (user, permission, object) within a permission_cache() context
+        """
+        user = Mock()
+        user.has_perm.side_effect = lambda permission_required, obj=None: obj is not None
+        request = Mock()
+        request.user = user
+        view = Mock(spec=['permission_required'])
+        obj = Mock()
+        permission = SimpleDjangoObjectPermissions()
+
+        def check():
+            user.has_perm.reset_mock()
+            self.assertFalse(permission.has_permission(request, view))
+            self.assertTrue(permission.has_object_permission(request, view, obj))
+            self.assertTrue(permission.has_object_permission(request, view, obj))
+            self.assertFalse(has_perm(view.permission_required).test(user))
+            return user.has_perm.call_count
+
+        self.assertEqual(check(), 6)
+        with permission_cache():
+            self.assertEqual(check(), 2)
+            with permission_cache():
+                self.assertEqual(check(), 0)
+            self.assertEqual(check(), 0)
+
+            clear_permission_cache()
+            self.assertEqual(check(), 2)
+
+            # a different object is checked separately
+            obj = Mock()
+            self.assertEqual(check(), 1)
+        self.assertEqual(check(), 6)
+
+    @skipIf(sync_to_async is None or contextvars is None, 'async middleware requires asgiref & contextvars')
+    def test_permission_cache_async(self):
+        """
+        Async requests each have their own cache, which is shared with work run in other threads
+        """
+        user = Mock()
+        user.has_perm.return_value = True
+
+        async def get_response(request):
+            cached_has_perm(user, 'app.view_thing')
+            await sync_to_async(cached_has_perm, thread_sensitive=False)(user, 'app.view_thing')
+            await asyncio.sleep(0)
+            return HttpResponse()
+
+        middleware = PermissionCacheMiddleware(get_response)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+
+        async def run_requests():
+            await asyncio.gather(*(middleware(RequestFactory().get('/')) for i in range(2)))
+
+        asyncio.run(run_requests())
+        self.assertEqual(user.has_perm.call_count, 2)
+
+    @override_settings(
+        AUTHENTICATION_BACKENDS=(
+            'rules.permissions.ObjectPermissionBackend',
+            'django.contrib.auth.backends.ModelBackend',
+        ),
+    )
+    def test_has_perm_batch(self):
+        """
+        Batch permission checks evaluate batchable() rules once for all objects
+        """
+        user = User.objects.create(email="test@example.com")
+        turtles = [
+            NinjaTurtleModel(name=name, color=color, shell_size=Decimal("12.0"))
+            for name, color in (("leonardo", "blue"), ("raphael", "red"), ("donatello", "purple"))
+        ]
+        calls = []
+
+        def is_color(color):
+            def batch_test(user, turtles):
+                calls.append(("batch", color, len(turtles)))
+                return [turtle.color == color for turtle in turtles]
+
+            @batchable(batch_test)
+            @rules.predicate
+            def check(user, turtle):
+                calls.append(("single", color))
+                return turtle is not None and turtle.color == color
+
+            return check
+
+        rules.set_perm("test.is_red", is_color("red"))
+        rules.set_perm("test.is_blue", is_color("blue"))
+        rules.set_perm("test.is_purple", rules.predicate(lambda user, turtle: turtle is not None and turtle.color == "purple"))
+        for perm in ("test.is_red", "test.is_blue", "test.is_purple"):
+            self.addCleanup(rules.remove_perm, perm)
+
+        self.assertEqual(has_perm_batch(user, "test.is_red", turtles), [False, True, False])
+        self.assertEqual(calls, [("batch", "red", 3)])
+
+        # permissions without a batchable() declaration are checked one object at a time
+        self.assertEqual(has_perm_batch(user, "test.is_purple", turtles), [False, False, True])
+
+        calls.clear()
+        self.assertEqual(has_any_perms_batch(user, ["test.is_red", "test.is_blue"], turtles), [True, True, False])
+        self.assertEqual(calls, [("batch", "red", 3), ("batch", "blue", 2)])
+        self.assertEqual(has_perms_batch(user, ["test.is_red", "test.is_blue"], turtles), [False, False, False])
+
+        # results are shared with the permission cache
+        with permission_cache():
+            calls.clear()
+            self.assertEqual(has_perm_batch(user, "test.is_red", turtles), [False, True, False])
+            self.assertTrue(cached_has_perm(user, "test.is_red", turtles[1]))
+            self.assertEqual(has_perm_batch(user, "test.is_red", turtles), [False, True, False])
+            self.assertEqual(calls, [("batch", "red", 3)])
+
+        user.is_superuser = True
+        self.assertEqual(has_perm_batch(user, "test.is_red", turtles), [True, True, True])
+        user.is_superuser = False
+
+        # checks are recorded by permission_profile()
+        with permission_profile() as stats:
+            has_perm_batch(user, "test.is_red", turtles)
+        self.assertEqual(stats["test.is_red"].object_calls, 3)
+
+        # a user model that overrides has_perm() is always asked directly
+        calls.clear()
+        with patch.object(User, "has_perm", autospec=True, side_effect=lambda user, perm, obj=None: obj is turtles[0]):
+            self.assertEqual(has_perm_batch(user, "test.is_red", turtles), [True, False, False])
+        self.assertEqual(calls, [])
+
+    def test_perm_predicates_interned(self):
+        """
+        Identical permission predicates are shared and only evaluated once per rule check
+        """
+        self.assertIs(has_perm("a.b"), has_perm("a.b"))
+        self.assertIs(has_perms(["a.b", "a.c"]), has_perms(("a.b", "a.c")))
+        self.assertIs(has_any_perms(["a.b", "a.c"]), has_any_perms(["a.b", "a.c"]))
+        self.assertIsNot(has_perm("a.b"), has_perm("a.c"))
+        self.assertIsNot(has_perm("a.b"), has_perms(["a.b"]))
+        obj = Mock()
+        self.assertIsNot(has_perm("a.b", obj), has_perm("a.b", obj))
+
+        user = Mock()
+        user.has_perm.side_effect = lambda perm, obj=None: perm == "a.c"
+        predicate = (has_perm("a.b") | has_perm("a.c")) & ~has_perm("a.b")
+        self.assertTrue(predicate.test(user))
+        self.assertEqual([call[0][0] for call in user.has_perm.call_args_list], ["a.b", "a.c"])
+
+        # each rule check is evaluated separately
+        user.has_perm.reset_mock()
+        self.assertTrue(predicate.test(user))
+        self.assertEqual(user.has_perm.call_count, 2)
+
+        # called directly outside of a rule check
+        self.assertFalse(has_perm("a.b")(user))
@@ -0,0 +1,116 @@
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+
+from allianceutils.query_assertions import get_query_profile
+from allianceutils.query_assertions import query_profile
+from allianceutils.query_assertions import QueryProfileTestCaseMixin
+
+
+class QueryAssertionsTestCase(QueryProfileTestCaseMixin, TestCase):
+
+    def run_queries(self, count: int = 1):
+        for i in range(count):
+            list(get_user_model().objects.filter(id=i))
+
+    def test_max_queries(self):
+        with self.assertMaxQueries(2):
+            self.run_queries(2)
+        with self.assertMaxQueries(2, using='default'):
+            self.run_queries(2)
+        with self.assertMaxQueries(0, using='other'):
+            self.run_queries(2)
+
+        with self.assertRaisesRegex(AssertionError, r'^3 queries run, expected at most 2:\n3x SELECT .* WHERE .* = \?$'):
+            with self.assertMaxQueries(2):
+                self.run_queries(3)
+        with self.assertRaisesRegex(AssertionError, r'^3 queries run on database "default", expected at most 2'):
+            with self.assertMaxQueries(2, using='default'):
+                self.run_queries(3)
+
+    def test_no_duplicate_queries(self):
+        with self.assertNoDuplicateQueries():
+            self.run_queries(1)
+            list(get_user_model().objects.all())
+        with self.assertNoDuplicateQueries(threshold=2):
+            self.run_queries(2)
+
+        with self.assertRaises(AssertionError) as cm:
+            with self.assertNoDuplicateQueries():
+                self.run_queries(2)
+        message = str(cm.exception)
+        self.assertRegex(message, r'^1 queries run more than 1 times:\n2x SELECT ')
+        self.assertRegex(message, r'\n    at .*test_query_assertions\.py:\d+ in run_queries$')
+
+    def test_query_profile(self):
+        with query_profile() as counter:
+            self.run_queries(2)
+            list(get_user_model().objects.all())
+        self.assertEqual(counter.count, 3)
+        self.assertEqual(counter.counts, {'default': 3})
+
+        expected = get_query_profile(counter)
+        with self.assertQueryProfile(expected):
+            self.run_queries(2)
+            list(get_user_model().objects.all())
+
+        with self.assertRaises(AssertionError) as cm:
+            with self.assertQueryProfile(expected):
+                self.run_queries(3)
+        lines = str(cm.exception).split('\n')
+        self.assertEqual(lines[:3], ['Query profile changed:', '--- expected', '+++ actual'])
+        self.assertTrue(any(line.startswith('-2x SELECT') for line in lines))
+        self.assertTrue(any(line.startswith('+3x SELECT') for line in lines))
+        self.assertTrue(any(line.startswith('-1x SELECT') for line in lines))
+
+    def test_decorator(self):
+        @query_profile(max_queries=1)
+        def run(count):
+            self.run_queries(count)
+
+        run(1)
+        with self.assertRaises(AssertionError):
+            run(2)
+
+    def test_nested(self):
+        """
+        Reusing the same instance doesn't mix up the counts of the outer & inner blocks
+        """
+        profile = query_profile(max_queries=3)
+        with self.assertRaisesRegex(AssertionError, r'^4 queries run, expected at most 3'):
+            with profile as outer:
+                self.run_queries(1)
+                with profile as inner:
+                    self.run_queries(3)
+        self.assertEqual(inner.count, 3)
+        # the outer block counts the inner block's queries too
+        self.assertEqual(outer.count, 4)
+
+        with profile as counter:
+            self.run_queries(1)
+        self.assertEqual(counter.count, 1)
+
+    def test_decorator_recursive(self):
+        @query_profile(max_queries=2)
+        def run(depth):
+            self.run_queries(1)
+            if depth:
+                run(depth - 1)
+
+        run(1)
+        with self.assertRaisesRegex(AssertionError, r'^3 queries run, expected at most 2'):
+            run(2)
+
+    def test_combined(self):
+        """
+        All failed checks are reported together; nothing is checked if the block raises
+        """
+        with self.assertRaises(AssertionError) as cm:
+            with query_profile(max_queries=1, duplicate_threshold=1):
+                self.run_queries(2)
+        self.assertIn('2 queries run, expected at most 1', str(cm.exception))
+        self.assertIn('1 queries run more than 1 times', str(cm.exception))
+
+        with self.assertRaises(ValueError):
+            with query_profile(max_queries=0):
+                self.run_queries(1)
+                raise ValueError()
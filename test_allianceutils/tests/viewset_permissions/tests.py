@@ -2,25 +2,35 @@ from decimal import Decimal
 from typing import Optional
 from typing import Set
 from unittest import skip
+from unittest.mock import patch
 
 from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth.models import Permission
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
 from django.db import transaction
+from django.db.models import Q
 from django.test import Client
 from django.test import modify_settings
 from django.test import override_settings
 from django.test import TestCase
 from django.urls import reverse
 from rest_framework import viewsets
+from rest_framework.decorators import action
+from rest_framework.response import Response
 from rest_framework.test import APIClient
 from rest_framework.test import APIRequestFactory
 from rest_framework.test import force_authenticate
+import rules
 
 from allianceutils.api.permissions import GenericDjangoViewsetPermissions
+from allianceutils.api.permissions import ObjectPermissionFilterBackend
+from allianceutils.rules import filterable
 from test_allianceutils.tests.profile_auth.models import User
 from test_allianceutils.tests.viewset_permissions.models import NinjaTurtleModel
 from test_allianceutils.tests.viewset_permissions.models import SenseiRatModel
 from test_allianceutils.tests.viewset_permissions.views import NinjaTurtleSerializer
+from test_allianceutils.tests.viewset_permissions.views import NinjaTurtleViewSet
 
 USER_EMAIL = "test@example.com"
 USER_PASS = "password"
@@ -38,6 +48,14 @@ class IgnoreObjectsBackend:
         return None
 
 
+class ObjectOnlyBackend:
+    """
+    Grants every permission, but only when checked against an object
+    """
+    def has_perm(self, user_obj, perm, obj=None):
+        return obj is not None
+
+
 @override_settings(
     MIDDLEWARE=(
         'django.contrib.sessions.middleware.SessionMiddleware',
@@ -202,4 +220,164 @@ class ViewsetPermissionsTestCase(TestCase):
         test_methods("view_ninjaturtlemodel")  # should fail; perm lookup would hit SenseiRat who is going to say no
         test_methods("view_senseiratmodel", SenseiRatModel, {"view"})  # should succeed with permission from SenseiRat
 
+    @override_settings(
+        AUTHENTICATION_BACKENDS=(
+            'test_allianceutils.tests.viewset_permissions.tests.ObjectOnlyBackend',
+        ),
+    )
+    def test_object_permission_fetches_object_once(self):
+        """
+        When only object permissions are granted, the object fetched for the permission check is reused by the view
+        """
+        factory = APIRequestFactory()
+
+        class NinjaTurtleRefetchViewSet(viewsets.ModelViewSet):
+            queryset = NinjaTurtleModel.objects.all()
+            serializer_class = NinjaTurtleSerializer
+            permission_classes = [GenericDjangoViewsetPermissions]
+            permission_cache_object = False
+
+        for viewset, query_count in ((NinjaTurtleViewSet, 1), (NinjaTurtleRefetchViewSet, 2)):
+            with self.subTest(viewset.__name__):
+                view = viewset.as_view({"get": "retrieve"})
+                request = factory.get("")
+                force_authenticate(request, user=self.user)
+                with self.assertNumQueries(query_count):
+                    response = view(request, pk=self.turtle.id).render()
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.data["id"], self.turtle.id)
+
+    @override_settings(
+        AUTHENTICATION_BACKENDS=(
+            'rules.permissions.ObjectPermissionBackend',
+            'django.contrib.auth.backends.ModelBackend',
+        ),
+    )
+    def test_object_permission_filter_backend(self):
+        """
+        List actions are filtered down to records the user has object permission for
+        """
+        factory = APIRequestFactory()
+        red_turtle = NinjaTurtleModel.objects.create(name="raphael", color="red", shell_size=Decimal("12.5"))
+        NinjaTurtleModel.objects.create(name="donatello", color="purple", shell_size=Decimal("12.3"))
+
+        @rules.predicate
+        def is_red(user, turtle):
+            return turtle is not None and turtle.color == "red"
 
+        class NinjaTurtleFilteredViewSet(viewsets.ModelViewSet):
+            queryset = NinjaTurtleModel.objects.order_by("id")
+            serializer_class = NinjaTurtleSerializer
+            permission_classes = [GenericDjangoViewsetPermissions]
+            filter_backends = [ObjectPermissionFilterBackend]
+
+        def list_names():
+            view = NinjaTurtleFilteredViewSet.as_view({"get": "list"})
+            request = factory.get("")
+            force_authenticate(request, user=User.objects.get(pk=self.user.pk))
+            response = view(request).render()
+            self.assertEqual(response.status_code, 200)
+            return [turtle["name"] for turtle in response.data]
+
+        perm = "viewset_permissions.view_ninjaturtlemodel"
+        self.addCleanup(rules.remove_perm, perm)
+        is_red_filterable = filterable(lambda user: Q(color="red"))(rules.predicate(is_red.fn))
+        for predicate, in_database in ((is_red, False), (is_red_filterable, True)):
+            with self.subTest(in_database=in_database):
+                rules.set_perm(perm, predicate)
+
+                # user + 2 global permission lookups + list; checking in python adds a query for candidate records
+                with self.assertNumQueries(4 if in_database else 5):
+                    self.assertEqual(list_names(), ["leonardo", "raphael"])
+
+                # global permission: no filtering
+                self.grant_permission("view_ninjaturtlemodel")
+                self.assertEqual(list_names(), ["leonardo", "raphael", "donatello"])
+                self.user.user_permissions.clear()
+
+        # non-list actions are not filtered
+        view = NinjaTurtleFilteredViewSet.as_view({"get": "retrieve"})
+        request = factory.get("")
+        force_authenticate(request, user=User.objects.get(pk=self.user.pk))
+        self.assertEqual(view(request, pk=red_turtle.id).render().status_code, 200)
+
+    @override_settings(
+        AUTHENTICATION_BACKENDS=(
+            'rules.permissions.ObjectPermissionBackend',
+            'django.contrib.auth.backends.ModelBackend',
+        ),
+    )
+    def test_object_permission_filter_backend_custom_list_action(self):
+        """
+        Custom list actions aren't assumed to filter their queryset so still need the global permission unless they
+        are listed in object_permission_filter_actions
+        """
+        factory = APIRequestFactory()
+        NinjaTurtleModel.objects.create(name="donatello", color="purple", shell_size=Decimal("12.3"))
+
+        perm = "viewset_permissions.view_ninjaturtlemodel"
+        self.addCleanup(rules.remove_perm, perm)
+        rules.set_perm(perm, filterable(lambda user: Q(color="red"))(rules.predicate(lambda user, turtle: False)))
+
+        class NamesPermissions(GenericDjangoViewsetPermissions):
+            actions_to_perms_map = {
+                "all_names": ["%(app_label)s.view_%(model_name)s"],
+                "filtered_names": ["%(app_label)s.view_%(model_name)s"],
+            }
+
+        class NinjaTurtleFilteredViewSet(viewsets.ModelViewSet):
+            queryset = NinjaTurtleModel.objects.order_by("id")
+            serializer_class = NinjaTurtleSerializer
+            permission_classes = [NamesPermissions]
+            filter_backends = [ObjectPermissionFilterBackend]
+
+            @action(detail=False)
+            def all_names(self, request):
+                return Response([turtle.name for turtle in self.get_queryset()])
+
+        def get_names(viewset, action_name):
+            view = viewset.as_view({"get": action_name})
+            request = factory.get("")
+            force_authenticate(request, user=User.objects.get(pk=self.user.pk))
+            return view(request).render()
+
+        self.assertEqual(get_names(NinjaTurtleFilteredViewSet, "all_names").status_code, 403)
+
+        class NinjaTurtleOptInViewSet(NinjaTurtleFilteredViewSet):
+            object_permission_filter_actions = ("list", "filtered_names")
+
+            @action(detail=False)
+            def filtered_names(self, request):
+                return Response([turtle.name for turtle in self.filter_queryset(self.get_queryset())])
+
+        self.assertEqual(get_names(NinjaTurtleOptInViewSet, "all_names").status_code, 403)
+        response = get_names(NinjaTurtleOptInViewSet, "filtered_names")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, ["leonardo"])
+
+    @override_settings(
+        AUTHENTICATION_BACKENDS=(
+            'rules.permissions.ObjectPermissionBackend',
+            'django.contrib.auth.backends.ModelBackend',
+        ),
+    )
+    def test_object_permission_filter_backend_too_many_records(self):
+        """
+        Checking permissions in python refuses to filter by more pks than the database accepts as parameters
+        """
+        NinjaTurtleModel.objects.create(name="donatello", color="purple", shell_size=Decimal("12.3"))
+        perm = "viewset_permissions.view_ninjaturtlemodel"
+        self.addCleanup(rules.remove_perm, perm)
+        rules.set_perm(perm, rules.predicate(lambda user, turtle: True))
+
+        backend = ObjectPermissionFilterBackend()
+        queryset = NinjaTurtleModel.objects.order_by("id")
+        user = User.objects.get(pk=self.user.pk)
+        self.assertEqual(backend.filter_queryset_in_python(user, [perm], queryset).count(), 2)
+
+        with patch.object(connection.features, "max_query_params", 2):
+            with self.assertRaises(ImproperlyConfigured):
+                backend.filter_queryset_in_python(user, [perm], queryset)
+
+        backend.batch_size = 1
+        self.assertEqual(backend.filter_queryset_in_python(user, [perm], queryset).count(), 2)